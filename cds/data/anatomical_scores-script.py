@@ -0,0 +1,56 @@
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import sys
+import pathlib
+import pandas as pd
+import cds.model.losses as L
+from cds.model.anatomical_table import AnatomicalTable
+
+# Scores written to the table at once
+WRITE_EVERY = 10_000
+
+def _scored(diagram: str):
+    score, fingering = L.compute_anatomical_score(diagram)
+    return diagram, score, fingering
+
+def main(parser: ArgumentParser) -> int:
+    args = parser.parse_args()
+    SOURCEPATH = pathlib.Path(args.sourcepath)
+    if SOURCEPATH.is_dir():
+        chord_pairs = list(SOURCEPATH.glob('*.csv'))
+    else:
+        chord_pairs = [SOURCEPATH]
+    diagrams = set()
+    for path in chord_pairs:
+        df = pd.read_csv(path, usecols=['current_position', 'next_position'],
+                dtype=str, keep_default_na=False)
+        diagrams.update(df['current_position'])
+        diagrams.update(df['next_position'])
+    table = AnatomicalTable(args.outpath)
+    missing = sorted(diagrams - table.diagrams())
+    print(f"{len(diagrams)} diagrams, {len(missing)} to score.")
+    rows = []
+    with Pool(args.workers) as pool:
+        for i, row in enumerate(pool.imap_unordered(_scored, missing, chunksize=64)):
+            rows.append(row)
+            if len(rows) == WRITE_EVERY:
+                table.put_many(rows)
+                rows = []
+                if args.verbose:
+                    print(f"{i + 1}/{len(missing)} diagrams scored.")
+    table.put_many(rows)
+    print(f"{len(table)} diagrams in {args.outpath}.")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Compute the anatomical score of every diagram of chord pairs files.")
+    parser.add_argument('-s', '--sourcepath', type=str, required=True,
+            help="Chord pairs .csv file, or folder of such files.")
+    parser.add_argument('-o', '--outpath', type=str, required=True,
+            help="Anatomical table to fill (created if needed).")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+            help="Number of processes computing scores, all CPUs by default.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+            help="Enable verbose output.")
+    sys.exit(main(parser))
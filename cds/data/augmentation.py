@@ -0,0 +1,213 @@
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+import torch
+import cds.data.chord_functions as F
+import cds.exceptions as E
+from cds.config import NUM_FRETS, NUM_STRINGS, PITCH_CLASSES
+
+MUTED = -1
+# Transpositions up stop when a shape reaches this fret
+TWELFTH_FRET = 12
+NO_LIMIT = np.iinfo(np.int64).max
+
+
+def _down_steps(fret: int) -> int:
+    """
+    Semitones down until the fret contains a '0' (0, 10, 20...), which is
+    what shape_is_open_chord looks for.
+    """
+    k = 1
+    while '0' not in str(fret - k):
+        k += 1
+    return k
+
+
+# Semitones each fret can be transposed down, 0 for the frets containing a '0'
+DOWN_STEPS = torch.tensor([0 if '0' in str(f) else _down_steps(f)
+    for f in range(NUM_FRETS)])
+
+
+def parse_positions(positions: List[str]) -> np.ndarray:
+    """
+    Frets of each position, one column per string, MUTED for muted strings.
+    """
+    tokens = [p.split('.') for p in positions]
+    width = max((len(t) for t in tokens), default=0)
+    frets = np.full((len(tokens), width), MUTED, dtype=np.int64)
+    for i, t in enumerate(tokens):
+        for j, c in enumerate(t):
+            if c not in ['x', '']:
+                frets[i, j] = int(c)
+    return frets
+
+
+def transposition_ranges(frets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Number of semitones each position can be transposed down before becoming
+    an open chord, and up before reaching the twelfth fret. Positions without
+    fretted notes have no limit (NO_LIMIT).
+    """
+    played = frets != MUTED
+    down_table = np.array([0] + [_down_steps(f)
+        for f in range(1, frets.max(initial=0) + 1)], dtype=np.int64)
+    down = np.where(played, down_table[np.clip(frets, 0, None)], NO_LIMIT)
+    up = np.where(played, np.maximum(TWELFTH_FRET - frets, 0), NO_LIMIT)
+    return down.min(axis=1, initial=NO_LIMIT), up.min(axis=1, initial=NO_LIMIT)
+
+
+def _label_chains(labels, codes: np.ndarray, steps: np.ndarray,
+        shift: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Transpose each label by shift as many times as needed by its rows, each
+    label being transposed only once per step.
+
+    Returns:
+        flat chains of labels, offset of the chain of each label and number
+        of successful steps of each label (less than needed on a RootError).
+    """
+    max_steps = np.zeros(len(labels), dtype=np.int64)
+    np.maximum.at(max_steps, codes, steps)
+    flat = []
+    offsets = np.zeros(len(labels), dtype=np.int64)
+    reached = np.zeros(len(labels), dtype=np.int64)
+    for i, (label, n) in enumerate(zip(labels, max_steps)):
+        offsets[i] = len(flat)
+        flat.append(label)
+        try:
+            for _ in range(n):
+                flat.append(F.transpose_label(flat[-1], shift))
+                reached[i] += 1
+        except (E.RootError, ValueError):
+            # Not a chord label music21 understands, e.g. '4'
+            pass
+    return np.array(flat, dtype=object), offsets, reached
+
+
+def _shifted_positions(positions, codes: np.ndarray,
+        shifts: np.ndarray) -> np.ndarray:
+    # Each distinct (position, shift) is only computed once
+    keys, inverse = np.unique(np.stack((codes, shifts)), axis=1,
+            return_inverse=True)
+    shifted = np.array([F.transpose_pos(positions[c], s)
+        for c, s in zip(*keys)], dtype=object)
+    return shifted[inverse.reshape(-1)]
+
+
+def augment_pairs(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Same rows as TorchDataset.augment_from_row for all the rows of df, in the
+    same order. Pairs are transposed down until one of the positions is an
+    open chord and up until one reaches the twelfth fret. Pairs whose chords
+    can't be transposed are skipped (augment_from_row returns None or
+    raises).
+    """
+    columns = df.columns
+    df = df[~(df['current_position'].str.contains('0', regex=False)
+        | df['next_position'].str.contains('0', regex=False))]
+    current_codes, current_positions = pd.factorize(df['current_position'])
+    next_codes, next_positions = pd.factorize(df['next_position'])
+    current_down, current_up = transposition_ranges(
+            parse_positions(current_positions))
+    next_down, next_up = transposition_ranges(parse_positions(next_positions))
+    down = np.minimum(current_down[current_codes], next_down[next_codes])
+    up = np.minimum(current_up[current_codes], next_up[next_codes])
+    # Pairs without any fretted note would never stop
+    unbounded = (down == NO_LIMIT) | (up == NO_LIMIT)
+    down[unbounded] = 0
+    up[unbounded] = 0
+    keep = ~unbounded
+    chains = {}
+    for column in ['current_chord', 'next_chord']:
+        codes, labels = pd.factorize(df[column])
+        for shift, steps in [(-1, down), (1, up)]:
+            flat, offsets, reached = _label_chains(labels, codes, steps, shift)
+            keep &= reached[codes] >= steps
+            chains[column, shift] = flat, offsets[codes]
+    df = df[keep]
+    down = down[keep]
+    up = up[keep]
+    current_codes = current_codes[keep]
+    next_codes = next_codes[keep]
+    # Transpositions up from the highest, then down from the lowest
+    counts = up + down
+    rows = np.repeat(np.arange(len(df)), counts)
+    p = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    up_rows = up[rows]
+    shifts = np.where(p < up_rows, up_rows - p, p - up_rows - down[rows])
+    out = [df['filename'].astype(str).to_numpy()[rows] + '-augmented',
+           df['measure'].to_numpy()[rows]]
+    for column in ['current_chord', 'next_chord']:
+        flat_down, offsets_down = chains[column, -1]
+        flat_up, offsets_up = chains[column, 1]
+        offsets_down = offsets_down[keep][rows]
+        offsets_up = offsets_up[keep][rows]
+        out.append(np.where(shifts > 0,
+            flat_up[offsets_up + np.maximum(shifts, 0)],
+            flat_down[offsets_down + np.maximum(-shifts, 0)]))
+    out.append(_shifted_positions(current_positions, current_codes[rows], shifts))
+    out.append(_shifted_positions(next_positions, next_codes[rows], shifts))
+    return pd.DataFrame(dict(zip(columns, out)), columns=columns)
+
+
+def roll_rows(t: torch.Tensor, shifts: torch.Tensor) -> torch.Tensor:
+    """
+    Roll each sample of t (batch, ..., n) along the last axis by its shift.
+    """
+    n = t.shape[-1]
+    index = (torch.arange(n) - shifts.view(-1, *[1] * (t.dim() - 1))) % n
+    return torch.gather(t, -1, index.expand_as(t))
+
+
+def fret_bounds(fingerings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Lowest and highest pressed fret of each many-hot fingering
+    (batch, strings, frets), NUM_FRETS and -1 when no fret is pressed.
+    """
+    pressed = fingerings[..., :NUM_FRETS] > 0.5
+    frets = torch.arange(NUM_FRETS)
+    lowest = torch.where(pressed, frets, NUM_FRETS).amin(dim=(1, 2))
+    highest = torch.where(pressed, frets, -1).amax(dim=(1, 2))
+    return lowest, highest
+
+
+def transposition_bounds(current: torch.Tensor,
+        next: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Same bounds as augment_pairs, on many-hot fingerings: pairs are transposed
+    down until a fret contains a '0' (0, 10, 20...) and up until a fret
+    reaches the twelfth fret, and pairs that already have such a fret are not
+    transposed. Unlike augment_pairs, pairs whose chord labels music21 can't
+    transpose are transposed too, as only the pitch classes are rolled.
+    """
+    pressed = torch.cat((current, next), dim=1)[..., :NUM_FRETS] > 0.5
+    down = torch.where(pressed, DOWN_STEPS, NUM_FRETS).amin(dim=(1, 2))
+    _, current_high = fret_bounds(current)
+    _, next_high = fret_bounds(next)
+    high = torch.maximum(current_high, next_high)
+    fixed = (down == 0) | (high < 0)
+    down = torch.where(fixed, 0, down)
+    up = torch.where(fixed, 0, (TWELFTH_FRET - high).clamp(min=0))
+    return down, up
+
+
+def random_transpositions(inputs: torch.Tensor, targets: torch.Tensor,
+        with_mute: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Transpose each sample of a batch of TorchDataset samples by a random
+    number of semitones within its bounds (0 included), by rolling the
+    fingerings along the frets and both halves of the chord vector.
+    """
+    num_frets = NUM_FRETS + 1 if with_mute else NUM_FRETS
+    current = inputs[:, :-2*PITCH_CLASSES].reshape(-1, NUM_STRINGS, num_frets)
+    chord = inputs[:, -2*PITCH_CLASSES:].reshape(-1, 2, PITCH_CLASSES)
+    next = targets.reshape(-1, NUM_STRINGS, num_frets)
+    down, up = transposition_bounds(current, next)
+    shifts = (torch.rand(len(inputs)) * (down + up + 1)).long() - down
+    current = torch.cat((roll_rows(current[..., :NUM_FRETS], shifts),
+        current[..., NUM_FRETS:]), dim=-1)
+    next = torch.cat((roll_rows(next[..., :NUM_FRETS], shifts),
+        next[..., NUM_FRETS:]), dim=-1)
+    chord = roll_rows(chord, shifts)
+    inputs = torch.cat((current.flatten(1), chord.flatten(1)), dim=1)
+    return inputs, next.flatten(1)
@@ -6,6 +6,8 @@ from typing import Dict
 
 import music21 as m21
 
+from gp_archive import open_gpif
+
 FINGERS = {
     "Index": 1,
     "Middle": 2,
@@ -17,9 +19,22 @@ FINGERS = {
 }
 
 
-def get_diagram_collection(file: str, tuning=[40, 45, 50, 55, 59, 64]) -> Dict:
-    tree = ET.parse(file)
-    root = tree.getroot()
+def get_root(file: str | ET.Element) -> ET.Element:
+    """
+    Return the GPIF root of a .gpif file or .gp archive. An already parsed
+    root is returned as is, so that one parse can be shared by several
+    functions.
+    """
+    if isinstance(file, ET.Element):
+        return file
+    with open_gpif(file) as f:
+        return ET.parse(f).getroot()
+
+
+def get_diagram_collection(
+    file: str | ET.Element, tuning=[40, 45, 50, 55, 59, 64]
+) -> Dict:
+    root = get_root(file)
     collection_xml = root.find(
         "./Tracks/Track/Staves/Staff/Properties/Property[@name='DiagramCollection']"
     )
@@ -34,9 +49,8 @@ def get_diagram_collection(file: str, tuning=[40, 45, 50, 55, 59, 64]) -> Dict:
     return collection
 
 
-def get_id2name(file: str) -> Dict:
-    tree = ET.parse(file)
-    root = tree.getroot()
+def get_id2name(file: str | ET.Element) -> Dict:
+    root = get_root(file)
     collection_xml = root.find(
         "./Tracks/Track/Staves/Staff/Properties/Property[@name='DiagramCollection']"
     )
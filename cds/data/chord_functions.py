@@ -1,7 +1,16 @@
-from typing import Tuple
+import functools
+from typing import Sequence, Tuple
+import numpy as np
 import music21 as m21
 import cds.exceptions as E
 
+# Pitch class of the roots of chord labels (letter and optional accidental)
+ROOT_PCS = {letter + alt: (pc + shift) % 12
+            for letter, pc in {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}.items()
+            for alt, shift in {'': 0, 'b': -1, '#': 1}.items()}
+# Spelling of each pitch class after a transposition, the one music21 gives
+SPELLINGS = ['C', 'C#', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'G#', 'A', 'Bb', 'B']
+
 
 def get_root_from_chordname(chord: str) -> str:
     idx = 0
@@ -43,26 +52,34 @@ def transpose_up(root1: str, root2: str, pos1: str, pos2: str) -> Tuple[str,str,
     new_pos2 = _shift_pos(pos2, root2, new_root2)
     return new_root1, new_root2, new_pos1, new_pos2
 
-def _previous_root(root: str) -> str:
+def _m21_transpose(root: str, shift: int) -> str:
+    # Roots that are not in ROOT_PCS, e.g. 'c' or 'E##', or not notes at all
     note = m21.note.Note(root)
-    previous = note.transpose(-1).name
-    if '-' in previous:
-        previous = previous.replace('-', 'b')
-    return previous
+    name = note.transpose(shift).name
+    if '-' in name:
+        name = name.replace('-', 'b')
+    return name
+
+def root_pc(root: str) -> int:
+    pc = ROOT_PCS.get(root)
+    if pc is None:
+        pc = m21.note.Note(root).pitch.midi % 12
+    return pc
+
+def _shift_root(root: str, shift: int) -> str:
+    pc = ROOT_PCS.get(root)
+    if pc is None:
+        return _m21_transpose(root, shift)
+    return SPELLINGS[(pc + shift) % 12]
+
+def _previous_root(root: str) -> str:
+    return _shift_root(root, -1)
 
 def _next_root(root: str) -> str:
-    note = m21.note.Note(root)
-    nextr = note.transpose(+1).name
-    if '-' in nextr:
-        nextr = nextr.replace('-', 'b')
-    return nextr
+    return _shift_root(root, +1)
 
 def _get_midi_diff(root1: str, root2: str) -> int:
-    midi2 = m21.note.Note(root2).pitch.midi
-    midi1 = m21.note.Note(root1).pitch.midi
-    midi1 = midi1 % 12
-    midi2 = midi2 % 12
-    diff = midi2 - midi1
+    diff = root_pc(root2) - root_pc(root1)
     if diff > 6:
         diff = diff - 12
     if diff < -6:
@@ -162,7 +179,12 @@ def update_chord(chord: str, old_root: str, new_root: str,
     out = replace_bass(out, old_bass, new_bass)
     return out
 
-def transpose(chordname: str, pos: str, shift: int) -> Tuple[str, str]:
+@functools.lru_cache(maxsize=None)
+def transpose_label(chordname: str, shift: int) -> str:
+    """
+    Chord label transposed by shift (+/- 1) semitone. Memoized, the same few
+    labels are transposed over and over during augmentation.
+    """
     root = get_root_from_chordname(chordname)
     bass = get_bass_from_chordname(chordname)
     if shift == 1:
@@ -177,8 +199,6 @@ def transpose(chordname: str, pos: str, shift: int) -> Tuple[str, str]:
                 raise E.RootError
         else:
             new_bass = ''
-        new_pos = transpose_pos(pos, shift)
-        new_chord = update_chord(chordname, root, new_root, bass, new_bass)
     elif shift == -1:
         try:
             new_root = _previous_root(root)
@@ -192,9 +212,35 @@ def transpose(chordname: str, pos: str, shift: int) -> Tuple[str, str]:
                 raise E.RootError
         else:
             new_bass = ''
-        new_pos = transpose_pos(pos, shift)
-        new_chord = update_chord(chordname, root, new_root, bass, new_bass)
     else:
         raise ValueError(f"Shift other than +/- 1 is not supported yet. You tried shifting with {shift}")
+    return update_chord(chordname, root, new_root, bass, new_bass)
+
+def transpose(chordname: str, pos: str, shift: int) -> Tuple[str, str]:
+    new_chord = transpose_label(chordname, shift)
+    new_pos = transpose_pos(pos, shift)
     return new_chord, new_pos
 
+def transpose_batch(chordnames: Sequence[str], positions: Sequence[str],
+        shifts: int | Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    transpose() of arrays of chord labels and positions, by the same shift or
+    one shift per row. Shifts of more than one semitone transpose the label
+    one semitone at a time. Each distinct (label, shift) and (position, shift)
+    is only transposed once.
+    """
+    chordnames = np.asarray(chordnames, dtype=object)
+    positions = np.asarray(positions, dtype=object)
+    shifts = np.broadcast_to(np.asarray(shifts, dtype=np.int64), chordnames.shape)
+    new_chords = {}
+    new_positions = {}
+    for chordname, pos, shift in zip(chordnames, positions, shifts.tolist()):
+        if (chordname, shift) not in new_chords:
+            new_chord = chordname
+            for _ in range(abs(shift)):
+                new_chord = transpose_label(new_chord, 1 if shift > 0 else -1)
+            new_chords[chordname, shift] = new_chord
+        if (pos, shift) not in new_positions:
+            new_positions[pos, shift] = transpose_pos(pos, shift)
+    return (np.array([new_chords[c, s] for c, s in zip(chordnames, shifts.tolist())], dtype=object),
+            np.array([new_positions[p, s] for p, s in zip(positions, shifts.tolist())], dtype=object))
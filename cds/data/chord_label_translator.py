@@ -3,124 +3,134 @@
 # The dictionary covers 95% of the chord labels found in MSB
 
 
+import functools
 import json
 import numpy as np
 import torch
 
 pc_dict = {'C':0,'D':2,'E':4,'F':5,'G':7,'A':9,'B':11}
+accidentals = {'':0,'b':11,'#':1}
+# Number of labels parse_chord_label remembers
+LABEL_CACHE_SIZE = 4096
+
+def root_chords(pc_name, pc):
+    # Chord labels of the root pc_name (pc_name, pc_name+'b' and pc_name+'#')
+    chord_dict = {}
+    # major chords
+    chord_dict[pc_name]=(pc,[pc,(pc+4)%12,(pc+7)%12]) # major chord
+    chord_dict[pc_name+'b']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12])
+    # minor chords
+    chord_dict[pc_name+'m']=(pc,[pc,(pc+3)%12,(pc+7)%12])
+    chord_dict[pc_name+'bm']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#m']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12])
+    # power chords
+    chord_dict[pc_name+'5']=(pc,[pc,(pc+7)%12])
+    chord_dict[pc_name+'b5']=((pc+11)%12,[(pc+11)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#5']=((pc+1)%12,[(pc+1)%12,(pc+1+7)%12])
+    # sus2 chords : Asus2
+    chord_dict[pc_name+'sus2']=(pc,[pc,(pc+2)%12,(pc+7)%12])
+    chord_dict[pc_name+'bsus2']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#sus2']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+7)%12])
+    # sus4 chords : Dsus4
+    chord_dict[pc_name+'sus4']=(pc,[pc,(pc+5)%12,(pc+7)%12])
+    chord_dict[pc_name+'bsus4']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#sus4']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+7)%12])
+    # maj 7 #11 chords : Fmaj7(#11)
+    chord_dict[pc_name+'maj7(#11)']=(pc,[pc,(pc+6)%12,(pc+4)%12,(pc+7)%12,(pc+11)%12])
+    chord_dict[pc_name+'bmaj7(#11)']=((pc+11)%12,[(pc+11)%12,(pc+11+6)%12,(pc+11+4)%12,(pc+11+7)%12],(pc+11+11)%12)
+    chord_dict[pc_name+'#maj7(#11)']=((pc+1)%12,[(pc+1)%12,(pc+1+6)%12,(pc+1+4)%12,(pc+1+7)%12],(pc+1+11)%12)
+    # add#11 chords : Cadd#11
+    chord_dict[pc_name+'add#11']=(pc,[pc,(pc+6)%12,(pc+4)%12,(pc+7)%12])
+    chord_dict[pc_name+'badd#11']=((pc+11)%12,[(pc+11)%12,(pc+11+6)%12,(pc+11+4)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#add#11']=((pc+1)%12,[(pc+1)%12,(pc+1+6)%12,(pc+1+4)%12,(pc+1+7)%12])
+    # add11 chords : Gadd11
+    chord_dict[pc_name+'add11']=(pc,[pc,(pc+5)%12,(pc+4)%12,(pc+7)%12])
+    chord_dict[pc_name+'badd11']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+4)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#add11']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+4)%12,(pc+1+7)%12])
+    # madd11 chords : Bmadd11
+    chord_dict[pc_name+'madd11']=(pc,[pc,(pc+5)%12,(pc+3)%12,(pc+7)%12])
+    chord_dict[pc_name+'bmadd11']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+3)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#madd11']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+3)%12,(pc+1+7)%12])
+    # add9 chords : Cadd9
+    chord_dict[pc_name+'add9']=(pc,[pc,(pc+2)%12,(pc+4)%12,(pc+7)%12])
+    chord_dict[pc_name+'badd9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+4)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#add9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+4)%12,(pc+1+7)%12])
+    # madd9 chords : Emadd9
+    chord_dict[pc_name+'madd9']=(pc,[pc,(pc+2)%12,(pc+3)%12,(pc+7)%12])
+    chord_dict[pc_name+'bmadd9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+3)%12,(pc+11+7)%12])
+    chord_dict[pc_name+'#madd9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+3)%12,(pc+1+7)%12])
+    # seventh chords : A7
+    chord_dict[pc_name+'7']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'b7']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # augmented dominant seventh chords : F7(#5)
+    chord_dict[pc_name+'7(#5)']=(pc,[pc,(pc+4)%12,(pc+8)%12,(pc+10)%12])
+    chord_dict[pc_name+'b7(#5)']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+8)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7(#5)']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+8)%12,(pc+1+10)%12])
+    # 7sus4 chords : A7sus4
+    chord_dict[pc_name+'7sus4']=(pc,[pc,(pc+5)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'b7sus4']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7sus4']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # 7sus9 chords : A7sus9
+    chord_dict[pc_name+'7sus9']=(pc,[pc,(pc+2)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'b7sus9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7sus9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # dominant sharp ninth chords : C7(#9)
+    chord_dict[pc_name+'7(#9)']=(pc,[pc,(pc+3)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'#7(b9)']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7(#9)']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # 7b9 chords : C7(b9)
+    chord_dict[pc_name+'7(b9)']=(pc,[pc,(pc+1)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'b7(b9)']=((pc+11)%12,[(pc+11)%12,(pc+11+1)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7(b9)']=((pc+1)%12,[(pc+1)%12,(pc+1+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # dominant seventh add b13 chords : C7(b13)
+    chord_dict[pc_name+'7(b13)']=(pc,[pc,(pc+8)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'b7(b13)']=((pc+11)%12,[(pc+11)%12,(pc+11+8)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#7(b13)']=((pc+1)%12,[(pc+1)%12,(pc+1+8)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # 9 chords : D9
+    chord_dict[pc_name+'9']=(pc,[pc,(pc+2)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'b9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # minor seventh chords : Em7
+    chord_dict[pc_name+'m7']=(pc,[pc,(pc+3)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'bm7']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#m7']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # minor sixth chords : Am6
+    chord_dict[pc_name+'m6']=(pc,[pc,(pc+3)%12,(pc+7)%12,(pc+9)%12])
+    chord_dict[pc_name+'bm6']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+9)%12])
+    chord_dict[pc_name+'#m6']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+9)%12])
+    # minor 9 chords : Em9
+    chord_dict[pc_name+'m9']=(pc,[pc,(pc+2)%12,(pc+3)%12,(pc+7)%12,(pc+10)%12])
+    chord_dict[pc_name+'bm9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+10)%12])
+    chord_dict[pc_name+'#m9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+10)%12])
+    # sixth chords : G6
+    chord_dict[pc_name+'6']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+9)%12])
+    chord_dict[pc_name+'b6']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+9)%12])
+    chord_dict[pc_name+'#6']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+9)%12])
+    # major seventh chords : Gmaj7
+    chord_dict[pc_name+'maj7']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+11)%12])
+    chord_dict[pc_name+'bmaj7']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+11)%12])
+    chord_dict[pc_name+'#maj7']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+11)%12])
+    # minor major seventh chords : Em(maj7)
+    chord_dict[pc_name+'m(maj7)']=(pc,[pc,(pc+3)%12,(pc+7)%12,(pc+11)%12])
+    chord_dict[pc_name+'bm(maj7)']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+11)%12])
+    chord_dict[pc_name+'#m(maj7)']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+11)%12])
+    # major seventh chords : C7M
+    chord_dict[pc_name+'7M']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+11)%12])
+    chord_dict[pc_name+'b7M']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+11)%12])
+    chord_dict[pc_name+'#7M']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+11)%12])
+    # diminished seventh chords : Adim7
+    chord_dict[pc_name+'dim7']=(pc,[pc,(pc+3)%12,(pc+6)%12,(pc+9)%12])
+    chord_dict[pc_name+'bdim7']=((pc+9)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+6)%12,(pc+11+11)%12])
+    chord_dict[pc_name+'#dim7']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+6)%12,(pc+1+9)%12])
+
+    return chord_dict
 
 def generate_chord_dict():
     chord_dict = {}
     for pc_name,pc in pc_dict.items():
-        # major chords
-        chord_dict[pc_name]=(pc,[pc,(pc+4)%12,(pc+7)%12]) # major chord
-        chord_dict[pc_name+'b']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12])
-        # minor chords
-        chord_dict[pc_name+'m']=(pc,[pc,(pc+3)%12,(pc+7)%12])
-        chord_dict[pc_name+'bm']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#m']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12])
-        # power chords
-        chord_dict[pc_name+'5']=(pc,[pc,(pc+7)%12])
-        chord_dict[pc_name+'b5']=((pc+11)%12,[(pc+11)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#5']=((pc+1)%12,[(pc+1)%12,(pc+1+7)%12])
-        # sus2 chords : Asus2
-        chord_dict[pc_name+'sus2']=(pc,[pc,(pc+2)%12,(pc+7)%12])
-        chord_dict[pc_name+'bsus2']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#sus2']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+7)%12])
-        # sus4 chords : Dsus4
-        chord_dict[pc_name+'sus4']=(pc,[pc,(pc+5)%12,(pc+7)%12])
-        chord_dict[pc_name+'bsus4']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#sus4']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+7)%12])
-        # maj 7 #11 chords : Fmaj7(#11)
-        chord_dict[pc_name+'maj7(#11)']=(pc,[pc,(pc+6)%12,(pc+4)%12,(pc+7)%12,(pc+11)%12])
-        chord_dict[pc_name+'bmaj7(#11)']=((pc+11)%12,[(pc+11)%12,(pc+11+6)%12,(pc+11+4)%12,(pc+11+7)%12],(pc+11+11)%12)
-        chord_dict[pc_name+'#maj7(#11)']=((pc+1)%12,[(pc+1)%12,(pc+1+6)%12,(pc+1+4)%12,(pc+1+7)%12],(pc+1+11)%12)
-        # add#11 chords : Cadd#11
-        chord_dict[pc_name+'add#11']=(pc,[pc,(pc+6)%12,(pc+4)%12,(pc+7)%12])
-        chord_dict[pc_name+'badd#11']=((pc+11)%12,[(pc+11)%12,(pc+11+6)%12,(pc+11+4)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#add#11']=((pc+1)%12,[(pc+1)%12,(pc+1+6)%12,(pc+1+4)%12,(pc+1+7)%12])
-        # add11 chords : Gadd11
-        chord_dict[pc_name+'add11']=(pc,[pc,(pc+5)%12,(pc+4)%12,(pc+7)%12])
-        chord_dict[pc_name+'badd11']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+4)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#add11']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+4)%12,(pc+1+7)%12])
-        # madd11 chords : Bmadd11
-        chord_dict[pc_name+'madd11']=(pc,[pc,(pc+5)%12,(pc+3)%12,(pc+7)%12])
-        chord_dict[pc_name+'bmadd11']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+3)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#madd11']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+3)%12,(pc+1+7)%12])
-        # add9 chords : Cadd9
-        chord_dict[pc_name+'add9']=(pc,[pc,(pc+2)%12,(pc+4)%12,(pc+7)%12])
-        chord_dict[pc_name+'badd9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+4)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#add9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+4)%12,(pc+1+7)%12])
-        # madd9 chords : Emadd9
-        chord_dict[pc_name+'madd9']=(pc,[pc,(pc+2)%12,(pc+3)%12,(pc+7)%12])
-        chord_dict[pc_name+'bmadd9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+3)%12,(pc+11+7)%12])
-        chord_dict[pc_name+'#madd9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+3)%12,(pc+1+7)%12])
-        # seventh chords : A7
-        chord_dict[pc_name+'7']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'b7']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # augmented dominant seventh chords : F7(#5)
-        chord_dict[pc_name+'7(#5)']=(pc,[pc,(pc+4)%12,(pc+8)%12,(pc+10)%12])
-        chord_dict[pc_name+'b7(#5)']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+8)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7(#5)']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+8)%12,(pc+1+10)%12])
-        # 7sus4 chords : A7sus4
-        chord_dict[pc_name+'7sus4']=(pc,[pc,(pc+5)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'b7sus4']=((pc+11)%12,[(pc+11)%12,(pc+11+5)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7sus4']=((pc+1)%12,[(pc+1)%12,(pc+1+5)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # 7sus9 chords : A7sus9
-        chord_dict[pc_name+'7sus9']=(pc,[pc,(pc+2)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'b7sus9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7sus9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # dominant sharp ninth chords : C7(#9)
-        chord_dict[pc_name+'7(#9)']=(pc,[pc,(pc+3)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'#7(b9)']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7(#9)']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # 7b9 chords : C7(b9)
-        chord_dict[pc_name+'7(b9)']=(pc,[pc,(pc+1)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'b7(b9)']=((pc+11)%12,[(pc+11)%12,(pc+11+1)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7(b9)']=((pc+1)%12,[(pc+1)%12,(pc+1+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # dominant seventh add b13 chords : C7(b13)
-        chord_dict[pc_name+'7(b13)']=(pc,[pc,(pc+8)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'b7(b13)']=((pc+11)%12,[(pc+11)%12,(pc+11+8)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#7(b13)']=((pc+1)%12,[(pc+1)%12,(pc+1+8)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # 9 chords : D9
-        chord_dict[pc_name+'9']=(pc,[pc,(pc+2)%12,(pc+4)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'b9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # minor seventh chords : Em7
-        chord_dict[pc_name+'m7']=(pc,[pc,(pc+3)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'bm7']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#m7']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # minor sixth chords : Am6
-        chord_dict[pc_name+'m6']=(pc,[pc,(pc+3)%12,(pc+7)%12,(pc+9)%12])
-        chord_dict[pc_name+'bm6']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+9)%12])
-        chord_dict[pc_name+'#m6']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+9)%12])
-        # minor 9 chords : Em9
-        chord_dict[pc_name+'m9']=(pc,[pc,(pc+2)%12,(pc+3)%12,(pc+7)%12,(pc+10)%12])
-        chord_dict[pc_name+'bm9']=((pc+11)%12,[(pc+11)%12,(pc+11+2)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+10)%12])
-        chord_dict[pc_name+'#m9']=((pc+1)%12,[(pc+1)%12,(pc+1+2)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+10)%12])
-        # sixth chords : G6
-        chord_dict[pc_name+'6']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+9)%12])
-        chord_dict[pc_name+'b6']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+9)%12])
-        chord_dict[pc_name+'#6']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+9)%12])
-        # major seventh chords : Gmaj7
-        chord_dict[pc_name+'maj7']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+11)%12])
-        chord_dict[pc_name+'bmaj7']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+11)%12])
-        chord_dict[pc_name+'#maj7']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+11)%12])
-        # minor major seventh chords : Em(maj7)
-        chord_dict[pc_name+'m(maj7)']=(pc,[pc,(pc+3)%12,(pc+7)%12,(pc+11)%12])
-        chord_dict[pc_name+'bm(maj7)']=((pc+11)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+7)%12,(pc+11+11)%12])
-        chord_dict[pc_name+'#m(maj7)']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+7)%12,(pc+1+11)%12])
-        # major seventh chords : C7M
-        chord_dict[pc_name+'7M']=(pc,[pc,(pc+4)%12,(pc+7)%12,(pc+11)%12])
-        chord_dict[pc_name+'b7M']=((pc+11)%12,[(pc+11)%12,(pc+11+4)%12,(pc+11+7)%12,(pc+11+11)%12])
-        chord_dict[pc_name+'#7M']=((pc+1)%12,[(pc+1)%12,(pc+1+4)%12,(pc+1+7)%12,(pc+1+11)%12])
-        # diminished seventh chords : Adim7
-        chord_dict[pc_name+'dim7']=(pc,[pc,(pc+3)%12,(pc+6)%12,(pc+9)%12])
-        chord_dict[pc_name+'bdim7']=((pc+9)%12,[(pc+11)%12,(pc+11+3)%12,(pc+11+6)%12,(pc+11+11)%12])
-        chord_dict[pc_name+'#dim7']=((pc+1)%12,[(pc+1)%12,(pc+1+3)%12,(pc+1+6)%12,(pc+1+9)%12])
-
+        chord_dict.update(root_chords(pc_name, pc))
     # Inversions
     inverted_chord_dict = {}
     for chord_name,pcs in chord_dict.items():
@@ -131,14 +141,69 @@ def generate_chord_dict():
     chord_dict = {**chord_dict, **inverted_chord_dict}
     return chord_dict
 
-chord_dict = generate_chord_dict()
+@functools.cache
+def quality_offsets():
+    # Chords of C without the root letter : the quality (and accidental) of
+    # the label, with pitch classes relative to the root
+    return {chord_name[1:]:chord_tuple for chord_name,chord_tuple in root_chords('C', 0).items()}
+
+@functools.lru_cache(maxsize=LABEL_CACHE_SIZE)
+def parse_chord_label(chord_label):
+    """
+    (bass_pc, chord_pcs) of a chord label, the same as chord_dict[chord_label],
+    or None if chord_dict doesn't have the label. The label is parsed as a
+    root letter, a quality and an optional inversion ('/' followed by a
+    letter and an accidental) instead of being looked up in chord_dict.
+    """
+    if not isinstance(chord_label, str) or chord_label[:1] not in pc_dict:
+        return None
+    chord_name, slash, inversion = chord_label.partition('/')
+    offsets = quality_offsets().get(chord_name[1:])
+    if offsets is None:
+        return None
+    pc = pc_dict[chord_name[0]]
+    bass_pc = (offsets[0]+pc)%12
+    chord_pcs = [(n+pc)%12 for n in offsets[1]]
+    if not slash:
+        # A few labels have a third element, transposed like the others
+        return (bass_pc,chord_pcs,*[(n+pc)%12 for n in offsets[2:]])
+    if inversion[:1] not in pc_dict or inversion[1:] not in accidentals:
+        return None
+    return ((pc_dict[inversion[0]]+accidentals[inversion[1:]])%12,chord_pcs)
+
+def is_chord_label(chord_label):
+    return parse_chord_label(chord_label) is not None
+
+def chord_key(bass_pc, pcs):
+    # 4 bits for the bass, 12 bits for the mask of the pitch classes
+    mask = 0
+    for pc in pcs:
+        mask |= 1 << pc
+    return (bass_pc << 12) | mask
+
+@functools.cache
+def chord_label_index():
+    # Label of each (bass, pitch classes) key, the first one of chord_dict when
+    # several labels have the same notes, like get_chord_label used to return
+    chord_index = np.full(12 << 12, None, dtype=object)
+    for chord_label_key, chord_tuple in reversed(generate_chord_dict().items()):
+        chord_index[chord_key(chord_tuple[0], chord_tuple[1])] = chord_label_key
+    return chord_index
+
+def __getattr__(name):
+    # chord_dict and chord_index are only generated when they are used
+    if name == 'chord_dict':
+        globals()['chord_dict'] = generate_chord_dict()
+        return globals()['chord_dict']
+    if name == 'chord_index':
+        return chord_label_index()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
 
 def get_chord_label_notes(chord_label):
-    if chord_label in chord_dict :
-        return chord_dict[chord_label]
-    else :
+    chord_tuple = parse_chord_label(chord_label)
+    if chord_tuple is None :
         print('{} is not in the chord dictionary.'.format(chord_label))
-        return None
+    return chord_tuple
 
 def get_vector_representation(chord_label, tensor: bool = False):
     #'Am7' : (9, [9, 0, 4, 7]) : [0,0,0,0,0,0,0,0,0,1,0,0,1,0,0,0,1,0,0,1,0,1,0,0]
@@ -154,16 +219,32 @@ def get_chord_label(chord_vector):
     assert len(chord_vector)==24, "chord_vector should be size 24 : {}".format(chord_vector)
     bass_vector = chord_vector[:12]
     assert np.count_nonzero(bass_vector==1)==1, "bass_vector should have exactly one digit to 1 : {}".format(bass_vector)
-    other_notes_vector = chord_vector[12:]
-    for chord_label_key,chord_tuple in chord_dict.items():
-        # print('{}-{}'.format(chord_label_key,chord_tuple))
-        bass_pc = chord_tuple[0]
-        other_notes_pc_list = chord_tuple[1]
-        dict_other_notes_vector = np.zeros(12)
-        for n in other_notes_pc_list : dict_other_notes_vector[n]=1
-        if bass_vector[bass_pc]==1 and np.array_equal(dict_other_notes_vector, other_notes_vector):
-            return chord_label_key
-    return 'chord symbol not found for {}'.format(chord_vector)
+    if isinstance(chord_vector, torch.Tensor):
+        label = get_chord_labels(chord_vector[None])[0]
+    else:
+        label = get_chord_labels(np.asarray(chord_vector)[None])[0]
+    if label is None:
+        return 'chord symbol not found for {}'.format(chord_vector)
+    return label
+
+def get_chord_labels(chord_vectors):
+    """
+    Labels of a [N, 24] array or tensor of chord vectors, None for the
+    vectors that don't match any chord label.
+    """
+    if isinstance(chord_vectors, torch.Tensor):
+        chord_vectors = chord_vectors.detach().cpu().numpy()
+    chord_vectors = np.asarray(chord_vectors)
+    assert chord_vectors.shape[-1]==24, "chord_vectors should be size 24 : {}".format(chord_vectors.shape)
+    bass_vectors = chord_vectors[:, :12] == 1
+    assert (bass_vectors.sum(axis=1)==1).all(), "bass_vectors should have exactly one digit to 1"
+    other_notes_vectors = chord_vectors[:, 12:]
+    keys = (bass_vectors.argmax(axis=1) << 12) \
+        | ((other_notes_vectors == 1) @ (1 << np.arange(12)))
+    labels = chord_label_index()[keys]
+    # Other values than 0 and 1 never match
+    labels[~((other_notes_vectors == 0) | (other_notes_vectors == 1)).all(axis=1)] = None
+    return list(labels)
         
 
 # print(get_chord_label_notes('Em'))
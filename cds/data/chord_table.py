@@ -0,0 +1,130 @@
+"""
+Reading and writing the tables of chorded measures produced by
+extract_chorded_measures.py.
+
+In .csv files, the Chords, Offsets and Shapes lists are stored as strings
+and Chords and Shapes need ast.literal_eval to be read back (Offsets may
+contain Fractions and are left as strings). In .parquet files they are
+native list columns, Offsets and Duration being stored as floats.
+"""
+
+import ast
+import pathlib
+from typing import Dict, Iterable, Iterator, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+COLUMNS = ["File", "Measure", "Duration", "Chords", "Offsets", "Shapes"]
+FORMATS = ("csv", "parquet")
+# Written by extract_chorded_measures.py next to the tables
+MANIFEST_NAME = "manifest.csv"
+SCHEMA = pa.schema(
+    [
+        ("File", pa.string()),
+        ("Measure", pa.int64()),
+        ("Duration", pa.float64()),
+        ("Chords", pa.list_(pa.string())),
+        ("Offsets", pa.list_(pa.float64())),
+        ("Shapes", pa.list_(pa.string())),
+    ]
+)
+CSV_CONVERTERS = {"Chords": ast.literal_eval, "Shapes": ast.literal_eval}
+# Number of rows accumulated before writing a row group
+CHUNK_SIZE = 100_000
+
+
+def _to_arrow_table(columns: Dict[str, List]) -> pa.Table:
+    # Fractions (e.g. triplets) are not supported by Arrow
+    columns = dict(columns)
+    columns["Duration"] = [float(d) for d in columns["Duration"]]
+    columns["Offsets"] = [[float(o) for o in l] for l in columns["Offsets"]]
+    return pa.table(columns, schema=SCHEMA)
+
+
+class ParquetChordWriter:
+    """
+    Accumulate rows in one list per column, and write them to a .parquet
+    file every chunk_size rows.
+    """
+
+    def __init__(self, path: str | pathlib.Path, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.columns = {column: [] for column in COLUMNS}
+        self._writer = pq.ParquetWriter(path, SCHEMA)
+
+    def __len__(self) -> int:
+        return len(self.columns["File"])
+
+    def add_rows(self, rows: Iterable[List]) -> None:
+        for row in rows:
+            for column, value in zip(COLUMNS, row):
+                self.columns[column].append(value)
+        if len(self) >= self.chunk_size:
+            self.flush()
+
+    def add_columns(self, columns: Dict[str, List]) -> None:
+        for column in COLUMNS:
+            self.columns[column].extend(columns[column])
+        if len(self) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self) == 0:
+            return
+        self._writer.write_table(_to_arrow_table(self.columns))
+        self.columns = {column: [] for column in COLUMNS}
+
+    def close(self) -> None:
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def write_parquet(rows: List[List], path: str | pathlib.Path) -> None:
+    with ParquetChordWriter(path) as writer:
+        writer.add_rows(rows)
+
+
+def read_parquet_columns(path: str | pathlib.Path) -> Dict[str, List]:
+    table = pq.read_table(path, schema=SCHEMA)
+    return {column: table.column(column).to_pylist() for column in COLUMNS}
+
+
+def read_chord_table(path: str | pathlib.Path) -> pd.DataFrame:
+    """
+    Read a .csv or .parquet table of chorded measures, with Chords, Offsets
+    and Shapes as Python lists.
+    """
+    path = pathlib.Path(path)
+    if path.suffix == ".parquet":
+        return pd.DataFrame(read_parquet_columns(path), columns=COLUMNS)
+    return pd.read_csv(path, index_col=0, converters=CSV_CONVERTERS)
+
+
+def iter_chord_table(
+    path: str | pathlib.Path, chunk_size: int = CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    Same as read_chord_table, by chunks of at most chunk_size rows.
+    """
+    path = pathlib.Path(path)
+    if path.suffix == ".parquet":
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield pd.DataFrame(
+                {
+                    column: batch.column(column).to_pylist()
+                    for column in COLUMNS
+                },
+                columns=COLUMNS,
+            )
+        return
+    yield from pd.read_csv(
+        path, index_col=0, converters=CSV_CONVERTERS, chunksize=chunk_size
+    )
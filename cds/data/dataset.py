@@ -1,13 +1,59 @@
+import hashlib
+import os
+import pathlib
+import random
+import shutil
+import tempfile
+from typing import Iterator, List, Tuple
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import torch
-from cds.data.shape_to_manyhot import shape_to_manyhot
-from cds.data.chord_label_translator import get_vector_representation, get_chord_label_notes, get_chord_label
+from torch.utils.data import default_collate
+from cds.data.shape_to_manyhot import shape_to_manyhot, packed_to_manyhot
+from cds.data.packed_diagrams import pack_shapes, unpack_shapes
+from cds.data.chord_label_translator import get_vector_representation, get_chord_label, get_chord_labels, is_chord_label
 from cds.config import NUM_FRETS, NUM_STRINGS, PITCH_CLASSES
 import cds.data.chord_functions as F
 from cds.data.open_chords import shape_is_open_chord
-from tqdm import tqdm
+from cds.data.augmentation import augment_pairs, random_transpositions
 import cds.exceptions as E
 
+# Bump when the encoding of the samples changes, to invalidate cached tensors
+TENSOR_CACHE_VERSION = 1
+# Number of unknown chord labels listed when cleaning a dataset
+UNKNOWN_LABELS_SHOWN = 20
+# Samples held by each worker of a ShardedDataset to shuffle them
+SHUFFLE_BUFFER = 10_000
+# Rows of a shard encoded at once
+ENCODE_ROWS = 4096
+# Columns identifying duplicates, as in TorchDataset
+DEDUP_SUBSETS = {
+    'strict': ['filename', 'next_chord', 'next_position'],
+    'pairs': ['filename', 'current_chord', 'next_chord', 'current_position',
+        'next_position'],
+}
+
+
+def _tensor_cache_key(df_path: str, with_mute: bool, dedup: str,
+        augment: bool, packed: bool) -> str:
+    h = hashlib.sha256()
+    h.update(f"{TENSOR_CACHE_VERSION}-{with_mute}-{dedup}-{augment}-{packed}".encode())
+    h.update(b"\0")
+    with open(df_path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def known_labels(labels: pd.Series) -> pd.Series:
+    """
+    Whether each chord label is in the chord dictionary, each distinct label
+    being parsed once.
+    """
+    unique_labels = labels.unique()
+    return labels.isin([label for label in unique_labels if is_chord_label(label)])
+
 class SimpleDataset():
 
     def __init__(self, df_path: str | None, df: pd.DataFrame | None) -> None:
@@ -96,18 +142,69 @@ class TorchDataset(torch.utils.data.Dataset):
         t = tensor[-2*PITCH_CLASSES:]
         return get_chord_label(t)
 
+    @staticmethod
+    def chordlabels_from_source_tensor(tensor: torch.Tensor) -> List[str | None]:
+        """
+        Same as chordlabel_from_source_tensor for a batch of samples, None for
+        unknown chords.
+        """
+        return get_chord_labels(tensor[:, -2*PITCH_CLASSES:])
+
 
     def __init__(self, df_path: str | None, df: pd.DataFrame | None,
             with_mute: bool = True, drop_duplicates_strict: bool = True,
             drop_duplicates_stricter: bool = False,
             drop_duplicates_strictest: bool = False,
-            augment: bool = False) -> None:
+            augment: bool = False, pretensorize: bool = False,
+            cache_dir: str | None = None, lazy_augment: bool = False,
+            packed: bool = False) -> None:
+        """
+        With cache_dir, the encoded dataset (see pretensorize) is saved there
+        and memory-mapped by later runs on the same csv file and options,
+        without reading the df again: self.df is None in that case.
+
+        With lazy_augment, each sample is transposed by a random number of
+        semitones when it is read, instead of adding all transpositions to
+        the df like augment.
+
+        With packed, the dataset is encoded once like with pretensorize, but
+        each diagram is kept as one integer (see packed_diagrams.py) and
+        samples are expanded to many-hot tensors when they are read.
+        Positions can also be given as packed integers in the csv file.
+        """
         self.df_path: str | None
-        self.df: pd.DataFrame
+        self.df: pd.DataFrame | None
         self.unique_df: pd.DataFrame
         self.df_path = df_path
+        self.with_mute = with_mute
+        self.lazy_augment = lazy_augment
+        self.packed = packed
+        self.inputs: torch.Tensor | None = None
+        self.targets: torch.Tensor | None = None
+        # Packed current and next diagrams, and chord vectors
+        self.diagrams: torch.Tensor | None = None
+        self.chords: torch.Tensor | None = None
+        cache_path = None
+        if cache_dir is not None and df_path is not None:
+            if drop_duplicates_strictest:
+                dedup = 'strictest'
+            elif drop_duplicates_stricter:
+                dedup = 'stricter'
+            elif drop_duplicates_strict:
+                dedup = 'strict'
+            else:
+                dedup = 'pairs'
+            cache_path = pathlib.Path(cache_dir) / _tensor_cache_key(
+                    df_path, with_mute, dedup, augment, packed)
+            if self._load_tensors(cache_path):
+                self.df = None
+                super().__init__()
+                return
         self.df = pd.read_csv(df_path, index_col=0) if df_path is not None else df
         self.df = self.df.reset_index(drop=True)
+        for column in ['current_position', 'next_position']:
+            if pd.api.types.is_integer_dtype(self.df[column]):
+                self.df[column] = unpack_shapes(self.df[column])
         self._clean_df()
         if augment:
             self.data_augment()
@@ -129,20 +226,90 @@ class TorchDataset(torch.utils.data.Dataset):
             self.df = self.df.reset_index()
         if augment:
             self.df.to_csv('cleaned_df_with_augmentation.csv')
-        self.with_mute = with_mute
+        if pretensorize or packed or cache_path is not None:
+            self._tensorize()
+        if cache_path is not None:
+            self._save_tensors(cache_path)
         super().__init__()
 
+    def _tensor_names(self):
+        return ['diagrams', 'chords'] if self.packed else ['inputs', 'targets']
+
+    def _load_tensors(self, path: pathlib.Path) -> bool:
+        if not path.is_dir():
+            return False
+        for name in self._tensor_names():
+            # Copy-on-write: pages are shared by all processes until written
+            setattr(self, name, torch.from_numpy(
+                np.load(path / f'{name}.npy', mmap_mode='c')))
+        return True
+
+    def _save_tensors(self, path: pathlib.Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written in a temporary folder renamed at the end, so that other
+        # processes never see half-written entries
+        tmp_path = pathlib.Path(tempfile.mkdtemp(dir=path.parent))
+        try:
+            for name in self._tensor_names():
+                np.save(tmp_path / f'{name}.npy', getattr(self, name).numpy())
+            os.replace(tmp_path, path)
+        except OSError:
+            # Already written by another process
+            if not path.is_dir():
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @staticmethod
+    def collate(batch):
+        """
+        collate_fn for DataLoaders, batches returned by __getitems__ are already
+        collated.
+        """
+        if isinstance(batch, tuple):
+            return batch
+        return default_collate(batch)
+
+    def _tensorize(self):
+        """
+        Encode the whole df once, so that samples are only slices of two
+        tensors. Each distinct shape or label is only encoded once.
+        """
+        if self.packed:
+            chord_codes, chords = pd.factorize(self.df['next_chord'])
+            chord_vectors = torch.stack([get_vector_representation(chord, tensor=True)
+                for chord in chords]).type(torch.bool)
+            self.diagrams = torch.from_numpy(np.stack((
+                pack_shapes(self.df['current_position']),
+                pack_shapes(self.df['next_position'])), axis=1))
+            self.chords = chord_vectors[chord_codes].contiguous()
+            return
+        current_codes, current_shapes = pd.factorize(self.df['current_position'])
+        next_codes, next_shapes = pd.factorize(self.df['next_position'])
+        chord_codes, chords = pd.factorize(self.df['next_chord'])
+        current_fingerings = torch.stack([torch.flatten(shape_to_manyhot(
+            shape, with_mute=self.with_mute)) for shape in current_shapes]).type(torch.float)
+        next_fingerings = torch.stack([torch.flatten(shape_to_manyhot(
+            shape, with_mute=self.with_mute)) for shape in next_shapes]).type(torch.float)
+        chord_vectors = torch.stack([get_vector_representation(chord, tensor=True)
+            for chord in chords]).type(torch.float)
+        self.inputs = torch.cat((current_fingerings[current_codes],
+            chord_vectors[chord_codes]), dim=1).contiguous()
+        self.targets = next_fingerings[next_codes].contiguous()
+
     def _clean_df(self):
         """
         Some chord labels are not known yet. Remove them from the df until they're
         dealt with.
         """
-        to_drop = []
-        for i in range(len(self.df)):
-            if get_chord_label_notes(self.df.iloc[i]['next_chord']) is None:
-                to_drop.append(i)
-        self.df = self.df.drop(index=to_drop)
-        print(f"Dropped {len(to_drop)} unknown chords.")
+        known = known_labels(self.df['next_chord'])
+        unknown_labels = self.df.loc[~known, 'next_chord'].value_counts(dropna=False)
+        self.df = self.df[known]
+        print(f"Dropped {unknown_labels.sum()} unknown chords.")
+        if len(unknown_labels) > 0:
+            print(f"{len(unknown_labels)} labels are not in the chord dictionary, "
+                  f"the {min(len(unknown_labels), UNKNOWN_LABELS_SHOWN)} most frequent are:")
+            print(unknown_labels.head(UNKNOWN_LABELS_SHOWN).to_string())
 
     def _current_fingering_from_idx(self, index):
         return shape_to_manyhot(self.df.iloc[index]['current_position'],
@@ -155,26 +322,59 @@ class TorchDataset(torch.utils.data.Dataset):
     def _next_chord_from_idx(self, index):
         return get_vector_representation(self.df.iloc[index]['next_chord'], tensor=True)
 
+    def _unpack(self, indices):
+        """
+        Many-hot samples of packed diagrams, for a tensor of indices.
+        """
+        diagrams = packed_to_manyhot(self.diagrams[indices],
+                with_mute=self.with_mute).flatten(-2).type(torch.float)
+        inputs = torch.cat((diagrams[:, 0], self.chords[indices].type(torch.float)), dim=1)
+        return inputs, diagrams[:, 1]
+
     def __getitem__(self, index):
-        current_fingering = self._current_fingering_from_idx(index)
-        next_fingering = self._next_fingering_from_idx(index)
-        next_chord = self._next_chord_from_idx(index)
-        return torch.cat((torch.flatten(current_fingering), next_chord)), torch.flatten(next_fingering)
+        if self.inputs is not None:
+            inputs, targets = self.inputs[index], self.targets[index]
+        elif self.diagrams is not None:
+            inputs, targets = self._unpack(torch.tensor([index]))
+            inputs, targets = inputs[0], targets[0]
+        else:
+            current_fingering = self._current_fingering_from_idx(index)
+            next_fingering = self._next_fingering_from_idx(index)
+            next_chord = self._next_chord_from_idx(index)
+            inputs = torch.cat((torch.flatten(current_fingering), next_chord))
+            targets = torch.flatten(next_fingering)
+        if self.lazy_augment:
+            inputs, targets = random_transpositions(inputs[None], targets[None],
+                    self.with_mute)
+            return inputs[0], targets[0]
+        return inputs, targets
+
+    def __getitems__(self, indices):
+        """
+        Whole batch at once when the dataset is pretensorized, to be used with
+        collate as collate_fn. Otherwise, a list of samples.
+        """
+        if self.inputs is not None or self.diagrams is not None:
+            indices = torch.as_tensor(indices)
+            if self.inputs is not None:
+                inputs, targets = self.inputs[indices], self.targets[indices]
+            else:
+                inputs, targets = self._unpack(indices)
+            if self.lazy_augment:
+                return random_transpositions(inputs, targets, self.with_mute)
+            return inputs, targets
+        return [self[i] for i in indices]
 
     def __len__(self):
+        if self.inputs is not None:
+            return len(self.inputs)
+        if self.diagrams is not None:
+            return len(self.diagrams)
         return len(self.df)
 
     def data_augment(self):
-        to_add = []
-        for i, row in tqdm(self.df.iterrows()):
-            if '0' in row['current_position'] or '0' in row['next_position']:
-                continue
-            else:
-                new_df = self.augment_from_row(row)
-                if new_df is None:
-                    continue
-                to_add.append(new_df)
-        augmented_df = pd.concat(to_add, ignore_index=True)
+        # Same rows as augment_from_row on every row, all at once
+        augmented_df = augment_pairs(self.df)
         self.df = pd.concat([self.df, augmented_df], ignore_index=True) 
         self.df.to_csv(self.df_path + 'with_augmentation')
 
@@ -215,4 +415,92 @@ class TorchDataset(torch.utils.data.Dataset):
         return df
 
 
+class ShardedDataset(torch.utils.data.IterableDataset):
+    """
+    Same samples as TorchDataset, streamed from the Parquet shards written by
+    cds.data.shards instead of loaded at once. Shards are split between
+    processes (distributed ranks and DataLoader workers), each one reading
+    its shards in a random order and shuffling their samples in a buffer of
+    shuffle_buffer samples, so memory doesn't depend on the corpus size.
+    There should be more shards than processes, some processes get no
+    shard otherwise.
+
+    Duplicates are removed shard by shard, which is exact for dedup modes
+    that include the filename since a file is never split across shards.
+    """
+
+    def __init__(self, shards: str | List[str], with_mute: bool = True,
+            dedup: str | None = 'strict', shuffle_buffer: int = SHUFFLE_BUFFER,
+            lazy_augment: bool = False) -> None:
+        if isinstance(shards, (str, pathlib.Path)):
+            path = pathlib.Path(shards)
+            shards = sorted(path.glob('*.parquet')) if path.is_dir() else [path]
+        if dedup is not None and dedup not in DEDUP_SUBSETS:
+            raise ValueError(f"dedup must be one of {list(DEDUP_SUBSETS)} or None.")
+        self.shards = [pathlib.Path(s) for s in shards]
+        self.with_mute = with_mute
+        self.dedup = dedup
+        self.shuffle_buffer = shuffle_buffer
+        self.lazy_augment = lazy_augment
+        super().__init__()
+
+    def _process_shards(self) -> Tuple[List[pathlib.Path], random.Random]:
+        """
+        Shards of the current process, and a random generator that is
+        different for every process and epoch.
+        """
+        rank, world_size = 0, 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank = torch.distributed.get_rank()
+            world_size = torch.distributed.get_world_size()
+        info = torch.utils.data.get_worker_info()
+        if info is None:
+            worker, num_workers = 0, 1
+            seed = int(torch.randint(2**62, ()).item())
+        else:
+            # Different for each epoch, and reproducible with seed_everything
+            worker, num_workers, seed = info.id, info.num_workers, info.seed
+        process = rank * num_workers + worker
+        return self.shards[process::world_size * num_workers], random.Random(seed)
+
+    def _read_shard(self, path: pathlib.Path) -> pd.DataFrame:
+        df = pq.read_table(path).to_pandas()
+        df = df[known_labels(df['next_chord'])]
+        if self.dedup is not None:
+            df = df.drop_duplicates(subset=DEDUP_SUBSETS[self.dedup])
+        return df
+
+    def _encode(self, df: pd.DataFrame,
+            chord_vectors: dict) -> Tuple[torch.Tensor, torch.Tensor]:
+        for chord in df['next_chord'].unique():
+            if chord not in chord_vectors:
+                chord_vectors[chord] = get_vector_representation(chord, tensor=True)
+        chords = torch.stack([chord_vectors[c] for c in df['next_chord']]).type(torch.float)
+        diagrams = packed_to_manyhot(torch.from_numpy(np.stack((
+            df['current_position'].to_numpy(), df['next_position'].to_numpy()),
+            axis=1)), with_mute=self.with_mute).flatten(-2).type(torch.float)
+        inputs = torch.cat((diagrams[:, 0], chords), dim=1)
+        targets = diagrams[:, 1]
+        if self.lazy_augment:
+            inputs, targets = random_transpositions(inputs, targets, self.with_mute)
+        return inputs, targets
 
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        shards, rng = self._process_shards()
+        shards = rng.sample(shards, len(shards))
+        chord_vectors = {}
+        buffer = []
+        for path in shards:
+            df = self._read_shard(path)
+            for start in range(0, len(df), ENCODE_ROWS):
+                inputs, targets = self._encode(df.iloc[start:start + ENCODE_ROWS],
+                        chord_vectors)
+                for sample in zip(inputs, targets):
+                    if len(buffer) < self.shuffle_buffer:
+                        buffer.append(sample)
+                        continue
+                    i = rng.randrange(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
@@ -1,17 +1,30 @@
+import csv
 import itertools
+import multiprocessing
 import os
 import pathlib
+import signal
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
 
 import pandas as pd
 from music21 import *
 from tqdm import tqdm
 
-from chord_diagrams import (
-    chord_position_str,
-    get_diagram_collection,
-    get_id2name,
+from chord_diagrams import chord_position_str
+from chord_table import (
+    COLUMNS,
+    FORMATS,
+    MANIFEST_NAME,
+    ParquetChordWriter,
+    read_parquet_columns,
+    write_parquet,
 )
-from parserGP import ParserGP
+from gp_archive import GP_EXTENSIONS
+from gpif_iterparse import chorded_measures_from_gpif
+from score_cache import ScoreCache, load_or_parse_gpif
 from tab_functions import *
 
 PATH_TO_DATA = "/home/alexandre/PhD/data/"
@@ -20,8 +33,29 @@ gpifDir = PATH_TO_DATA + "DadaGP8-gpif/"
 gpif_files_path = PATH_TO_DATA + "DadaGP8-gpif/"
 csv_path = PATH_TO_DATA + "DadaGP-chordcsvTEST/"
 
-# Create directory if it doesn't exist
-pathlib.Path(csv_path).mkdir(parents=True, exist_ok=True)
+ENGINES = ("music21", "iterparse")
+MANIFEST_COLUMNS = ["File", "Status", "Seconds", "Rows", "Error"]
+# Files with these statuses are never processed again when resuming
+FINAL_STATUSES = ("done", "skipped")
+FAILED_STATUSES = ("error", "timeout")
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ExtractionTimeout
+
+
+# Parsed score cache of the current process, set by _init_worker
+score_cache: ScoreCache | None = None
+
+
+def _init_worker(cache_dir: str | None, cache_size: int) -> None:
+    global score_cache
+    if cache_dir is not None:
+        score_cache = ScoreCache(cache_dir, cache_size)
 
 
 def get_chords_and_positions(measure, collection=None, id2name=None):
@@ -65,44 +99,41 @@ def get_chords_and_positions(measure, collection=None, id2name=None):
     return list(chords), list(positions), chord_shapes
 
 
-df = pd.DataFrame(
-    columns=["File", "Measure", "Duration", "Chords", "Offsets", "Shapes"]
-)
-i = 0
-for file_name in tqdm(sorted(os.listdir(path=gpifDir)), total=84000):
-    # df = pd.DataFrame(columns = ['File','Measure','Duration','Chords','Offsets', 'Shapes'])
-    subdf_path = pathlib.Path(csv_path + file_name.replace(".gpif", ".csv"))
-    if subdf_path.exists():
-        subdf = pd.read_csv(subdf_path, index_col=0)
-        df = pd.concat([df, subdf])
-        continue
-    if file_name.endswith(".gpif"):
-        gpif_path = gpif_files_path + file_name
-        try:
-            collection = get_diagram_collection(gpif_path)
-            id2name = get_id2name(gpif_path)
-            if len(collection) == 0:
-                continue
-        except IndexError:
-            # probably not a six string guitar or bad encoding
-            continue
-        try:
-            s = ParserGP().parseFile(gpif_path)
-        except FileNotFoundError:
-            continue
-        except TypeError:
-            continue
-        part_number = len(s.getElementsByClass(stream.Part))
-        assert part_number == 1, "There should be one part only"
-        part = s.getElementsByClass(stream.Part)[0]
-        measure_number = len(part.getElementsByClass(stream.Measure))
-        print(file_name + " : {} measures".format(measure_number))
-        measure_index = 0
-        for measure in part.getElementsByClass(stream.Measure):
-            chords, positions, shapes = get_chords_and_positions(
-                measure, collection, id2name
-            )
-            df.loc[len(df)] = [
+def chorded_measures_from_score(
+    gpif_path: str, file_name: str, cache: ScoreCache | None = None
+) -> List | None:
+    """
+    Build the music21 score of a .gpif file (or .gp archive) and return one
+    row per measure (see COLUMNS). Returns None if the file should be skipped.
+    Scores found in the cache are not parsed again.
+    """
+    try:
+        # Parse the xml only once for the diagrams and the score
+        collection, id2name, s = load_or_parse_gpif(
+            gpif_path, cache, require_diagrams=True
+        )
+    except FileNotFoundError:
+        return None
+    except IndexError:
+        # probably not a six string guitar or bad encoding
+        return None
+    except TypeError:
+        return None
+    if len(collection) == 0:
+        return None
+    part_number = len(s.getElementsByClass(stream.Part))
+    assert part_number == 1, "There should be one part only"
+    part = s.getElementsByClass(stream.Part)[0]
+    measure_number = len(part.getElementsByClass(stream.Measure))
+    print(file_name + " : {} measures".format(measure_number))
+    rows = []
+    measure_index = 0
+    for measure in part.getElementsByClass(stream.Measure):
+        chords, positions, shapes = get_chords_and_positions(
+            measure, collection, id2name
+        )
+        rows.append(
+            [
                 file_name,
                 measure_index,
                 measure.duration.quarterLength,
@@ -110,8 +141,296 @@ for file_name in tqdm(sorted(os.listdir(path=gpifDir)), total=84000):
                 positions,
                 shapes,
             ]
-            measure_index += 1
-    subdf = df[df["File"] == file_name]
-    subdf.to_csv(subdf_path)
+        )
+        measure_index += 1
+    return rows
+
+
+def chorded_measures(
+    gpif_path: str,
+    file_name: str,
+    engine: str = "music21",
+    cache: ScoreCache | None = None,
+) -> List | None:
+    if engine == "iterparse":
+        return chorded_measures_from_gpif(gpif_path, file_name)
+    elif engine == "music21":
+        return chorded_measures_from_score(gpif_path, file_name, cache)
+    else:
+        raise ValueError(f"Unknown extraction engine {engine}.")
+
+
+def output_name(file_name: str, output_format: str = "csv") -> str:
+    return pathlib.Path(file_name).with_suffix("." + output_format).name
+
+
+def extract_file(task: Tuple[str, str, str, str, int, str]) -> List:
+    """
+    Extract one file and write its csv or parquet table. Any failure is
+    caught so that one bad file never stops the whole run.
+
+    Returns:
+        List: manifest row, see MANIFEST_COLUMNS.
+    """
+    gpif_path, file_name, subdf_path, engine, timeout, output_format = task
+    start = time.perf_counter()
+    num_rows = 0
+    error = ""
+    if timeout > 0:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(timeout)
+    try:
+        rows = chorded_measures(gpif_path, file_name, engine, score_cache)
+        if rows is None:
+            status = "skipped"
+        else:
+            # Write then rename, so that an interrupted run never leaves
+            # a truncated file behind
+            tmp_path = subdf_path + ".tmp"
+            if output_format == "parquet":
+                write_parquet(rows, tmp_path)
+            else:
+                pd.DataFrame(rows, columns=COLUMNS).to_csv(tmp_path)
+            os.replace(tmp_path, subdf_path)
+            status = "done"
+            num_rows = len(rows)
+    except ExtractionTimeout:
+        status = "timeout"
+    except Exception as e:
+        status = "error"
+        error = repr(e)
+    finally:
+        if timeout > 0:
+            signal.alarm(0)
+    seconds = round(time.perf_counter() - start, 3)
+    return [file_name, status, seconds, num_rows, error]
+
+
+def read_manifest(manifest_path: pathlib.Path) -> Dict[str, str]:
+    """
+    Returns:
+        Dict[str, str]: last recorded status of each file in the manifest.
+    """
+    if not manifest_path.exists():
+        return {}
+    manifest = pd.read_csv(manifest_path, keep_default_na=False)
+    return dict(zip(manifest["File"], manifest["Status"]))
+
+
+def run_extraction(
+    gpif_dir: pathlib.Path,
+    csv_dir: pathlib.Path,
+    manifest_path: pathlib.Path,
+    engine: str = "music21",
+    workers: int = 1,
+    timeout: int = 0,
+    retry_failed: bool = False,
+    cache_dir: str | None = None,
+    cache_size: int = 10 * 2**30,
+    output_format: str = "csv",
+) -> Dict[str, str]:
+    """
+    Extract every .gpif/.gp file of gpif_dir that is not already recorded in
+    the manifest, with a pool of worker processes. Each processed file is
+    appended to the manifest as soon as it is finished, so an interrupted
+    run can be resumed exactly. With cache_dir, the parsed scores are cached
+    and shared by the workers.
+
+    Returns:
+        Dict[str, str]: status of every file in the manifest.
+    """
+    statuses = read_manifest(manifest_path)
+    to_skip = (
+        FINAL_STATUSES if retry_failed else FINAL_STATUSES + FAILED_STATUSES
+    )
+    tasks = []
+    for file_name in sorted(os.listdir(path=gpif_dir)):
+        if not file_name.endswith(GP_EXTENSIONS):
+            continue
+        if statuses.get(file_name) in to_skip:
+            continue
+        subdf_path = csv_dir / output_name(file_name, output_format)
+        tasks.append(
+            (
+                str(gpif_dir / file_name),
+                file_name,
+                str(subdf_path),
+                engine,
+                timeout,
+                output_format,
+            )
+        )
+    print(f"{len(statuses)} files in manifest, {len(tasks)} files to process.")
+    write_header = not manifest_path.exists()
+    with open(manifest_path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(MANIFEST_COLUMNS)
+        if workers > 1:
+            pool = multiprocessing.Pool(
+                workers,
+                initializer=_init_worker,
+                initargs=(cache_dir, cache_size),
+            )
+            results = pool.imap_unordered(extract_file, tasks)
+        else:
+            pool = None
+            _init_worker(cache_dir, cache_size)
+            results = map(extract_file, tasks)
+        try:
+            for row in tqdm(results, total=len(tasks)):
+                writer.writerow(row)
+                f.flush()
+                statuses[row[0]] = row[1]
+                if row[1] in FAILED_STATUSES:
+                    print(f"{row[0]}: {row[1]} {row[4]}")
+        finally:
+            if pool is not None:
+                pool.terminate()
+    return statuses
+
+
+def main(parser: ArgumentParser) -> int:
+    args = parser.parse_args()
+    gpif_dir = pathlib.Path(args.gpif_dir)
+    csv_dir = pathlib.Path(args.csv_dir)
+    # Create directory if it doesn't exist
+    csv_dir.mkdir(parents=True, exist_ok=True)
+    cache_size = int(args.cache_size * 2**30)
+    if args.check_parity:
+        _init_worker(args.cache_dir, cache_size)
+        mismatches = 0
+        for file_name in tqdm(sorted(os.listdir(path=gpif_dir))):
+            if not file_name.endswith(GP_EXTENSIONS):
+                continue
+            gpif_path = str(gpif_dir / file_name)
+            expected = chorded_measures(
+                gpif_path, file_name, "music21", score_cache
+            )
+            rows = chorded_measures(gpif_path, file_name, "iterparse")
+            # Compare the representations, as they are what ends up in the csv
+            if str(rows) != str(expected):
+                print(f"{file_name}: iterparse rows differ from music21 rows.")
+                mismatches += 1
+        print(f"{mismatches} file(s) differ.")
+        return int(mismatches > 0)
+    manifest_path = (
+        pathlib.Path(args.manifest)
+        if args.manifest is not None
+        else csv_dir / MANIFEST_NAME
+    )
+    statuses = run_extraction(
+        gpif_dir,
+        csv_dir,
+        manifest_path,
+        engine=args.engine,
+        workers=args.workers,
+        timeout=args.timeout,
+        retry_failed=args.retry_failed,
+        cache_dir=args.cache_dir,
+        cache_size=cache_size,
+        output_format=args.format,
+    )
+    done = [
+        csv_dir / output_name(file_name, args.format)
+        for file_name, status in sorted(statuses.items())
+        if status == "done"
+    ]
+    outfile = pathlib.Path(args.outfile).with_suffix("." + args.format)
+    if args.format == "parquet":
+        # Tables are appended column by column and written in chunks
+        with ParquetChordWriter(outfile) as writer:
+            for subdf_path in done:
+                writer.add_columns(read_parquet_columns(subdf_path))
+        return 0
+    to_concat = [pd.read_csv(subdf_path, index_col=0) for subdf_path in done]
+    df = pd.concat(
+        [pd.DataFrame(columns=COLUMNS)] + to_concat, ignore_index=True
+    )
+    df.to_csv(outfile)
+    return 0
+
 
-df.to_csv("dadaGP_chords.csv")
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Find the measures with chord diagrams in a folder of .gpif files."
+    )
+    parser.add_argument(
+        "--gpif-dir",
+        "-g",
+        type=str,
+        default=gpifDir,
+        help="Path to the folder of .gpif files or .gp archives.",
+    )
+    parser.add_argument(
+        "--csv-dir",
+        "-c",
+        type=str,
+        default=csv_path,
+        help="Path to store one .csv (or .parquet) file per .gpif file.",
+    )
+    parser.add_argument(
+        "--outfile",
+        "-o",
+        type=str,
+        default="dadaGP_chords.csv",
+        help="Name/path to store the compiled .csv file. Its suffix is replaced by the output format.",
+    )
+    parser.add_argument(
+        "--format",
+        "-f",
+        type=str,
+        choices=FORMATS,
+        default="csv",
+        help="Output format. parquet stores Chords, Offsets and Shapes as list columns instead of strings.",
+    )
+    parser.add_argument(
+        "--engine",
+        "-e",
+        type=str,
+        choices=ENGINES,
+        default="music21",
+        help="music21 builds the full score with ParserGP, iterparse only reads what is needed from the XML.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes.",
+    )
+    parser.add_argument(
+        "--timeout",
+        "-t",
+        type=int,
+        default=600,
+        help="Maximum time in seconds spent on one file, 0 to disable.",
+    )
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        type=str,
+        help="Path to the manifest recording the status of every processed file. Defaults to manifest.csv in the csv folder.",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Process again files that failed or timed out in a previous run.",
+    )
+    parser.add_argument(
+        "--check-parity",
+        action="store_true",
+        help="Run both engines on every file and report files where they disagree.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Folder where parsed scores are cached, so that unchanged files are not parsed again by the music21 engine.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=10,
+        help="Maximum size of the score cache in GB, least recently used scores are removed first.",
+    )
+    sys.exit(main(parser))
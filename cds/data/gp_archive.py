@@ -0,0 +1,23 @@
+import io
+import pathlib
+import zipfile
+from typing import IO
+
+# GuitarPro 7/8 files are zip archives with the GPIF document inside
+GPIF_ENTRY = "Content/score.gpif"
+GP_EXTENSIONS = (".gp", ".gpif")
+
+
+def is_gp_archive(file) -> bool:
+    return pathlib.Path(file).suffix == ".gp"
+
+
+def open_gpif(file) -> IO[bytes]:
+    """
+    Open the GPIF document of a .gpif file, or of a .gp archive without
+    extracting it to disk.
+    """
+    if is_gp_archive(file):
+        with zipfile.ZipFile(file) as archive:
+            return io.BytesIO(archive.read(GPIF_ENTRY))
+    return open(file, "rb")
@@ -0,0 +1,294 @@
+"""
+Lightweight extraction of chorded measures from .gpif files.
+
+The rows are the same as the ones built by extract_chorded_measures.py from
+the music21 score produced by ParserGP, but they are computed directly from
+the MasterBars/Bars/Voices/Beats/Rhythms sections of the XML, read with
+ElementTree.iterparse. No music21 object is ever created, and the elements
+are cleared as soon as the few fields we need have been read.
+"""
+
+import pathlib
+import xml.etree.ElementTree as ET
+from fractions import Fraction
+from typing import Dict, List, Tuple
+
+from gp_archive import open_gpif
+
+# Same guitar icons as the ones accepted by ParserGP
+GUITAR_ICONS = ["1", "2", "4", "5", "23", "24", "25", "26", "22"]
+DIAGRAM_COLLECTION_PATH = (
+    "./Staves/Staff/Properties/Property[@name='DiagramCollection']"
+)
+# Same values as music21.duration.typeToDuration
+TYPE_TO_QUARTERLENGTH = {
+    "duplex-maxima": Fraction(64),
+    "maxima": Fraction(32),
+    "longa": Fraction(16),
+    "breve": Fraction(8),
+    "whole": Fraction(4),
+    "half": Fraction(2),
+    "quarter": Fraction(1),
+    "eighth": Fraction(1, 2),
+    "16th": Fraction(1, 4),
+    "32nd": Fraction(1, 8),
+    "64th": Fraction(1, 16),
+    "128th": Fraction(1, 32),
+    "256th": Fraction(1, 64),
+    "512th": Fraction(1, 128),
+    "1024th": Fraction(1, 256),
+    "2048th": Fraction(1, 512),
+    "zero": Fraction(0),
+}
+
+
+def _opfrac(value: Fraction) -> float | Fraction:
+    """
+    Mimic music21.common.opFrac: offsets and durations are floats when they
+    can be represented exactly, Fractions otherwise (e.g. triplets).
+    """
+    den = value.denominator
+    if den & (den - 1) == 0:
+        return float(value)
+    return value
+
+
+def _text(element: ET.Element | None) -> str | None:
+    return element.text if element is not None else None
+
+
+def diagram_position_str(
+    diagram: ET.Element, tuning=[40, 45, 50, 55, 59, 64]
+) -> str:
+    """
+    Same string as chord_position_str(get_chord_from_diagram(diagram)),
+    without building the music21 chord.
+    """
+    base_fret = diagram.get("baseFret")
+    base_fret = int(base_fret) if base_fret is not None else 0
+    if len(diagram.findall("Fret")) == 0:
+        raise ValueError("Chord is not properly defined.")
+    out = ["x"] * 6
+    for fret_xml in diagram.findall("Fret"):
+        fret = int(fret_xml.get("fret"))
+        if fret != 0:
+            fret += base_fret
+        string = int(fret_xml.get("string"))
+        # Raises IndexError for other instruments, like get_chord_from_diagram
+        tuning[string]
+        out[string] = str(fret)
+    return ".".join(out)
+
+
+def _rhythm_quarterlength(rhythm: ET.Element) -> Fraction:
+    note_value = rhythm.find("NoteValue").text.lower()
+    if note_value not in TYPE_TO_QUARTERLENGTH:
+        raise ValueError(f"Unknown note value {note_value}.")
+    ql = TYPE_TO_QUARTERLENGTH[note_value]
+    dot = rhythm.find("AugmentationDot")
+    if dot is not None:
+        dots = int(dot.get("count"))
+        ql = ql * (2 - Fraction(1, 2**dots))
+    tuplet = rhythm.find("PrimaryTuplet")
+    if tuplet is not None:
+        ql = ql * int(tuplet.get("den")) / int(tuplet.get("num"))
+    return ql
+
+
+class _GpifContent:
+    """
+    The parts of a .gpif document needed to locate chord diagrams in time.
+    """
+
+    def __init__(self) -> None:
+        self.track_ids: List[str] = []
+        self.track_icons: List[str | None] = []
+        self.collection: Dict[str, str | None] | None = None
+        self.id2name: Dict[str, str] = {}
+        self.master_bars: List[str] = []
+        # id -> (simile mark, voice ids)
+        self.bars: Dict[str, Tuple[str | None, str | None]] = {}
+        # id -> beat ids
+        self.voices: Dict[str, List[str]] = {}
+        # id -> (rhythm ref, number of notes or None, chord id, is grace)
+        self.beats: Dict[
+            str, Tuple[str | None, int | None, str | None, bool]
+        ] = {}
+        self.rhythms: Dict[str, Fraction] = {}
+
+    def add_track(self, track: ET.Element) -> None:
+        self.track_ids.append(track.get("id"))
+        self.track_icons.append(_text(track.find("./IconId")))
+        collection_xml = track.find(DIAGRAM_COLLECTION_PATH)
+        if self.collection is not None or collection_xml is None:
+            return
+        self.collection = {}
+        for item in collection_xml.findall("Items/Item"):
+            self.id2name[item.get("id")] = item.get("name")
+            try:
+                shape = diagram_position_str(item.find("Diagram"))
+            except ValueError:
+                continue
+            self.collection[item.get("id")] = shape
+
+    def add_record(self, section: str, element: ET.Element) -> None:
+        if section == "MasterBars":
+            self.master_bars.append(_text(element.find("./Bars")))
+            return
+        idx = element.get("id")
+        if section == "Bars":
+            simile = element.find("./SimileMark")
+            self.bars.setdefault(
+                idx,
+                (
+                    (simile.text or "") if simile is not None else None,
+                    _text(element.find("./Voices")),
+                ),
+            )
+        elif section == "Voices":
+            beats = _text(element.find("./Beats"))
+            self.voices.setdefault(idx, beats.split() if beats else [])
+        elif section == "Beats":
+            rhythm = element.find("./Rhythm")
+            notes = element.find("./Notes")
+            self.beats.setdefault(
+                idx,
+                (
+                    rhythm.get("ref") if rhythm is not None else None,
+                    (
+                        len((notes.text or "").split())
+                        if notes is not None
+                        else None
+                    ),
+                    _text(element.find("./Chord")),
+                    element.find("./GraceNotes") is not None,
+                ),
+            )
+        elif section == "Rhythms":
+            self.rhythms.setdefault(idx, _rhythm_quarterlength(element))
+
+
+RECORD_SECTIONS = ("MasterBars", "Bars", "Voices", "Beats", "Rhythms")
+
+
+def read_gpif(source) -> _GpifContent:
+    """
+    Read a .gpif file, a .gp archive or a binary file object.
+    """
+    if isinstance(source, (str, pathlib.Path)):
+        with open_gpif(source) as f:
+            return read_gpif(f)
+    content = _GpifContent()
+    path = []
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            path.append(element.tag)
+            continue
+        path.pop()
+        if len(path) != 2:
+            if len(path) == 1:
+                # A whole section has been read, drop it from the tree
+                element.clear()
+            continue
+        section = path[1]
+        if section == "Tracks":
+            content.add_track(element)
+        elif section in RECORD_SECTIONS:
+            content.add_record(section, element)
+        else:
+            continue
+        element.clear()
+    return content
+
+
+def _bar_voices(content: _GpifContent, bar_ids: List[str]) -> List[List[str]]:
+    # Follows how ParserGP fills measures with voices, including simile marks
+    out = []
+    for j, bar_id in enumerate(bar_ids):
+        simile, voices = content.bars.get(bar_id, (None, None))
+        if simile is not None:
+            previous = j - 1 if simile == "Simple" else j - 2
+            out.append(list(out[previous]) if previous >= 0 else [])
+        elif voices is not None:
+            out.append([v for v in voices.split() if v != "-1"])
+        else:
+            out.append([])
+    return out
+
+
+def _voice_chords(
+    content: _GpifContent, voice_id: str
+) -> Tuple[List[Tuple[Fraction, int, int, str]], Fraction]:
+    """
+    Return the chord ids found in a voice with their offsets, and the voice
+    duration. Elements are ordered like in get_chords_and_positions: by
+    offset, then grace notes, single notes and chords.
+    """
+    found = []
+    offset = Fraction(0)
+    for seq, beat_id in enumerate(content.voices.get(voice_id, [])):
+        rhythm, num_notes, chord_id, grace = content.beats.get(
+            beat_id, (None, None, None, False)
+        )
+        ql = content.rhythms.get(rhythm, Fraction(0))
+        if not num_notes:
+            # Rests do not carry the chord lyrics
+            offset += ql
+            continue
+        if grace:
+            # Only the first note of a grace chord is kept by ParserGP
+            if chord_id is not None and num_notes == 1:
+                found.append((offset, 0, seq, chord_id))
+            continue
+        if chord_id is not None:
+            found.append((offset, 1 if num_notes == 1 else 2, seq, chord_id))
+        offset += ql
+    found.sort()
+    return found, offset
+
+
+def chorded_measures_from_gpif(source, file_name: str) -> List | None:
+    """
+    Return one [File, Measure, Duration, Chords, Offsets, Shapes] row per
+    measure of a .gpif file. Returns None if the file should be skipped,
+    in the same cases as the music21 based extraction.
+    """
+    try:
+        content = read_gpif(source)
+    except IndexError:
+        # probably not a six string guitar or bad encoding
+        return None
+    except FileNotFoundError:
+        return None
+    if not content.collection:
+        return None
+    for icon in content.track_icons:
+        if icon not in GUITAR_ICONS:
+            return None
+    assert len(content.track_ids) == 1, "There should be one part only"
+    track_index = int(content.track_ids[0])
+    bar_ids = [bars.split()[track_index] for bars in content.master_bars]
+    rows = []
+    for measure_index, voice_ids in enumerate(_bar_voices(content, bar_ids)):
+        chords = []
+        positions = []
+        shapes = []
+        duration = Fraction(0)
+        for voice_id in voice_ids:
+            found, voice_duration = _voice_chords(content, voice_id)
+            duration = max(duration, voice_duration)
+            for offset, _, _, chord_id in found:
+                chords.append(content.id2name[chord_id])
+                positions.append(_opfrac(offset))
+                shapes.append(content.collection.get(chord_id))
+        rows.append(
+            [
+                file_name,
+                measure_index,
+                _opfrac(duration),
+                chords,
+                positions,
+                shapes,
+            ]
+        )
+    return rows
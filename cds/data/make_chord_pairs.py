@@ -1,16 +1,24 @@
-import ast
+import itertools
 import pathlib
 import random
 import sys
 from argparse import ArgumentParser
 from datetime import datetime
-from difflib import SequenceMatcher
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Sequence, Set, Tuple
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-MATCHER = SequenceMatcher(None, "", "")
+from chord_table import MANIFEST_NAME, iter_chord_table, read_chord_table
+from packed_diagrams import pack_shapes
+from song_groups import (
+    group_keys,
+    names_match,
+    normalize_name,
+    song_groups,
+    stable_hash,
+)
 
 OUT_COLUMNS = [
     "filename",
@@ -21,315 +29,664 @@ OUT_COLUMNS = [
     "next_position",
 ]
 CHORDOCC_COLUMNS = ["filename", "measure", "chordname", "position"]
+POSITION_COLUMNS = ["current_position", "next_position", "position"]
 IN_COLUMNS = ["File", "Measure", "Duration", "Chords", "Offsets", "Shapes"]
-INPUT_CONVERTERS = {
-    "Chords": ast.literal_eval,
-    "Offsets": ast.literal_eval,
-    "Shapes": ast.literal_eval,
-}
+UNIQUE_SUBSET = [
+    "filename",
+    "current_position",
+    "current_chord",
+    "next_position",
+    "next_chord",
+]
+# Rows read at once in streaming mode
+CHUNK_SIZE = 200_000
+SPLIT_MODES = ("random", "hash")
+SPLIT_NAMES = {"test": "Test", "val": "Validation", "train": "Training"}
 
 
 def filenames_match(n1: str, n2: str, t: float = 0.8) -> bool:
-    n1 = n1.upper()
-    n2 = n2.upper()
-    n1 = "".join(c for c in n1 if c.isalnum())
-    n2 = "".join(c for c in n2 if c.isalnum())
-    MATCHER.set_seqs(n1, n2)
-    r1 = MATCHER.ratio()
-    MATCHER.set_seqs(n2, n1)
-    r2 = MATCHER.ratio()
-    return (r1 > t) or (r2 > t)
-
-
-def _is_there_a_position(l: List) -> bool:
-    """
-    Check if input contains any chord position info.
-    """
-    if len(l) == 0:
-        return False
-    else:
-        for v in l:
-            if v is not None:
-                return True
-    return False
+    return names_match(normalize_name(n1), normalize_name(n2), t)
 
 
-def _process_single_row(row):
-    if len(row["Shapes"]) == 1 or None in row["Shapes"]:
-        return None
-    else:
-        out = []
-        for i in range(len(row["Shapes"]) - 1):
-            tmp = {}
-            tmp["filename"] = row["File"]
-            tmp["measure"] = row["Measure"]
-            tmp["current_chord"] = row["Chords"][i]
-            tmp["next_chord"] = row["Chords"][i + 1]
-            tmp["current_position"] = row["Shapes"][i]
-            tmp["next_position"] = row["Shapes"][i + 1]
-            out.append(tmp)
-    return out
-
-
-def _add_dict_to_df(d: dict, df: pd.DataFrame) -> pd.DataFrame:
-    df_dict = pd.DataFrame([d])
-    output = pd.concat([df, df_dict], ignore_index=True)
-    return output
-
-
-def _process_two_rows(row, previous_row):
+def _concat(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    df = pd.concat(frames, ignore_index=True)
+    # Pairs across two measures are at x.5, all measures are floats
+    df["measure"] = df["measure"].astype(float)
+    return df
+
+
+def _sorted(df: pd.DataFrame, keys: List[np.ndarray]) -> pd.DataFrame:
+    # keys go from the most significant to the least significant
+    return df.take(np.lexsort(keys[::-1])).reset_index(drop=True)
+
+
+def make_pairs(
+    df: pd.DataFrame, filenames: List[str]
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Both rows should have a chord position.
-    We have to check that the measures are consecutive.
+    Make all pairs of consecutive chords with known positions, inside one
+    measure or across two consecutive measures, and the chord occurences of
+    these pairs. The lists of all rows are flattened once and the pairs are
+    found with array operations. Files are output in the order of filenames.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: pairs (OUT_COLUMNS) and chord
+            occurences (CHORDOCC_COLUMNS).
     """
-    meas = row["Measure"]
-    prev_meas = previous_row["Measure"]
-    if meas - prev_meas > 1:
+    rank = pd.Series(np.arange(len(filenames)), index=filenames)
+    df = df[df["File"].isin(rank.index)]
+    files = df["File"].to_numpy()
+    file_ranks = rank.loc[files].to_numpy()
+    measures = df["Measure"].to_numpy()
+    lengths = df["Shapes"].map(len).to_numpy()
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    # One element per chord, with its row and its position in the row
+    element_rows = np.repeat(np.arange(len(df)), lengths)
+    element_pos = np.arange(len(element_rows)) - starts[element_rows]
+    chords = np.empty(len(element_rows), dtype=object)
+    chords[:] = list(itertools.chain.from_iterable(df["Chords"]))
+    shapes = np.empty(len(element_rows), dtype=object)
+    shapes[:] = list(itertools.chain.from_iterable(df["Shapes"]))
+    known = np.not_equal(shapes, None)
+    num_known = np.bincount(element_rows[known], minlength=len(df))
+    # Only rows with at least one position are considered
+    has_position = num_known > 0
+    # Pairs inside a measure, when all its positions are known
+    first = np.flatnonzero(
+        (element_rows[:-1] == element_rows[1:])
+        & (num_known == lengths)[element_rows[:-1]]
+    )
+    single_rows = element_rows[first]
+    single = {
+        "rows": single_rows,
+        "measure": measures[single_rows],
+        "current": first,
+        "next": first + 1,
+        "order": element_pos[first],
+    }
+    # Pairs across a row and the row with the previous index label, if it
+    # belongs to the same file
+    labels = df.index.to_numpy()
+    previous = df.index.get_indexer(labels - 1)
+    rows = np.flatnonzero(has_position & (labels > 0) & (previous >= 0))
+    previous = previous[rows]
+    keep = has_position[previous] & (files[previous] == files[rows])
+    rows = rows[keep]
+    previous = previous[keep]
+    if (measures[rows] - measures[previous] > 1).any():
         # Should never happen but sanity check
         raise ValueError
-    else:
-        out = {}
-        out["filename"] = row["File"]
-        out["measure"] = prev_meas + 0.5
-        out["current_chord"] = previous_row["Chords"][-1]
-        out["next_chord"] = row["Chords"][0]
-        out["current_position"] = previous_row["Shapes"][-1]
-        out["next_position"] = row["Shapes"][0]
-        if out["current_position"] is None or out["next_position"] is None:
-            return None
-    return out
+    keep = known[ends[previous] - 1] & known[starts[rows]]
+    rows = rows[keep]
+    previous = previous[keep]
+    two = {
+        "rows": rows,
+        "measure": measures[previous] + 0.5,
+        "current": ends[previous] - 1,
+        "next": starts[rows],
+        # after the pairs inside the measure
+        "order": np.full(len(rows), np.iinfo(np.int64).max),
+    }
+    pairs = []
+    occurences = []
+    pair_keys = []
+    occurence_keys = []
+    for kind, measure_offset in ((single, 0), (two, 0.5)):
+        keys = [file_ranks[kind["rows"]], kind["rows"], kind["order"]]
+        pairs.append(
+            pd.DataFrame(
+                {
+                    "filename": files[kind["rows"]],
+                    "measure": kind["measure"],
+                    "current_chord": chords[kind["current"]],
+                    "next_chord": chords[kind["next"]],
+                    "current_position": shapes[kind["current"]],
+                    "next_position": shapes[kind["next"]],
+                }
+            )
+        )
+        pair_keys.append(keys)
+        # Occurences of both chords, with the measure they belong to
+        for i, (which, sign) in enumerate((("current", -1), ("next", 1))):
+            occurences.append(
+                pd.DataFrame(
+                    {
+                        "filename": files[kind["rows"]],
+                        "measure": (
+                            kind["measure"] + sign * measure_offset
+                            if measure_offset
+                            else kind["measure"]
+                        ),
+                        "chordname": chords[kind[which]],
+                        "position": shapes[kind[which]],
+                    }
+                )
+            )
+            occurence_keys.append(keys + [np.full(len(kind["rows"]), i)])
+    out = _sorted(
+        _concat(pairs),
+        [np.concatenate(k) for k in zip(*pair_keys)],
+    )
+    chord_occ = _sorted(
+        _concat(occurences),
+        [np.concatenate(k) for k in zip(*occurence_keys)],
+    )
+    return out, chord_occ
+
+
+def pack_positions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Diagrams stored as packed integers (see packed_diagrams.py) instead of
+    strings.
+    """
+    df = df.copy()
+    for column in POSITION_COLUMNS:
+        if column in df.columns:
+            df[column] = pack_shapes(df[column])
+    return df
 
 
 def process_subdf(
     subdf: pd.DataFrame,
 ) -> Tuple[pd.DataFrame, pd.DataFrame] | Tuple[None, None]:
-    out = pd.DataFrame(columns=OUT_COLUMNS)
-    chord_occ = pd.DataFrame(columns=CHORDOCC_COLUMNS)
     # First check is there is any position information at all
-    if not (subdf["Shapes"].apply(_is_there_a_position).any()):
-        return None, None
-    # Then check only rows that have at least one position
-    df = subdf[subdf["Shapes"].apply(_is_there_a_position)]
-    for idx, row in df.iterrows():
-        res = None
-        res = _process_single_row(row)
-        if res is not None:
-            for r in res:
-                out = _add_dict_to_df(r, out)
-                dict_chord_occ1 = {
-                    "filename": r["filename"],
-                    "measure": r["measure"],
-                    "chordname": r["current_chord"],
-                    "position": r["current_position"],
-                }
-                dict_chord_occ2 = {
-                    "filename": r["filename"],
-                    "measure": r["measure"],
-                    "chordname": r["next_chord"],
-                    "position": r["next_position"],
-                }
-                chord_occ = pd.concat(
-                    [
-                        chord_occ,
-                        pd.DataFrame([dict_chord_occ1]),
-                        pd.DataFrame([dict_chord_occ2]),
-                    ],
-                    ignore_index=True,
-                )
-        if idx > 0:
-            try:
-                previous_row = df.loc[idx - 1]
-            except KeyError:
-                # Previous row is not there, moving on.
-                continue
-            res = _process_two_rows(row, previous_row)
-            if res is not None:
-                out = _add_dict_to_df(res, out)
-                dict_chord_occ1 = {
-                    "filename": res["filename"],
-                    "measure": (
-                        res["measure"] - 0.5
-                        if int(res["measure"]) != res["measure"]
-                        else res["measure"]
-                    ),
-                    "chordname": res["current_chord"],
-                    "position": res["current_position"],
-                }
-                dict_chord_occ2 = {
-                    "filename": res["filename"],
-                    "measure": (
-                        res["measure"] + 0.5
-                        if int(res["measure"]) != res["measure"]
-                        else res["measure"]
-                    ),
-                    "chordname": res["next_chord"],
-                    "position": res["next_position"],
-                }
-                chord_occ = pd.concat(
-                    [
-                        chord_occ,
-                        pd.DataFrame([dict_chord_occ1]),
-                        pd.DataFrame([dict_chord_occ2]),
-                    ],
-                    ignore_index=True,
-                )
-    return out, chord_occ
+    if subdf["Shapes"].map(lambda l: any(v is not None for v in l)).any():
+        return make_pairs(subdf, subdf["File"].unique())
+    return None, None
+
+
+def split_by_song(
+    sizes: pd.Series,
+    filenames: List[str],
+    test_size: float,
+    validation_size: float,
+) -> Tuple[Set[str], Set[str], Set[str]]:
+    """
+    Assign whole song groups (see song_groups.py) to the test, validation
+    and train sets. Groups are taken in the order of their first file in
+    filenames: the test set is filled until it has test_size pairs, then the
+    validation set, and the remaining groups go to the train set. sizes is
+    the number of pairs of each file.
+
+    Returns:
+        Tuple[Set[str], Set[str], Set[str]]: test, validation and train files.
+    """
+    groups = {}
+    for filename, group in zip(filenames, song_groups(filenames)):
+        groups.setdefault(group, []).append(filename)
+    splits = (set(), set(), set())
+    split_sizes = [0, 0, 0]
+    limits = (test_size, validation_size, np.inf)
+    k = 0
+    for members in groups.values():
+        while split_sizes[k] >= limits[k]:
+            k += 1
+        splits[k].update(members)
+        split_sizes[k] += sizes.reindex(members, fill_value=0).sum()
+    return splits
+
+
+def hash_split_names(folds: int = 0) -> List[str]:
+    if folds > 0:
+        return ["test"] + [f"fold{k}" for k in range(folds)]
+    return ["test", "val", "train"]
+
+
+def hash_split(
+    filenames: List[str],
+    test_split: float,
+    validation_split: float,
+    folds: int = 0,
+    known_files: Sequence[str] = (),
+    known_splits: Dict[str, str] | None = None,
+) -> pd.DataFrame:
+    """
+    Assign song groups to the test, validation and train sets from the hash
+    of their key (see song_groups.group_keys). The split of a group doesn't
+    depend on the other groups. known_files are only used to find the
+    groups, e.g. the files of a previous run when only new files are
+    processed.
+
+    known_splits pins the split of the files of a previous run, so that
+    adding files never moves them, even when a new file changes the key of
+    their group. A group with pinned files takes the split of its pinned
+    file with the smallest name, and only the other groups are hashed.
+
+    With folds > 0, the files that are not in the test set are split in
+    folds "fold0", "fold1", ... instead of validation and train sets.
+
+    Returns:
+        pd.DataFrame: filename, group key and split of each file.
+    """
+    known_splits = known_splits or {}
+    names = hash_split_names(folds)
+    unknown = set(known_splits.values()).difference(names)
+    if unknown:
+        raise ValueError(
+            f"Known splits {sorted(unknown)} don't exist with --folds {folds}."
+        )
+    all_files = list(
+        dict.fromkeys(itertools.chain(filenames, known_files, known_splits))
+    )
+    keys = dict(zip(all_files, group_keys(all_files)))
+    group_splits = {}
+    for f in sorted(f for f in all_files if f in known_splits):
+        group_splits.setdefault(keys[f], known_splits[f])
+    splits = []
+    for f in filenames:
+        if f in known_splits:
+            splits.append(known_splits[f])
+            continue
+        if keys[f] in group_splits:
+            splits.append(group_splits[keys[f]])
+            continue
+        u = stable_hash(keys[f])
+        if u < test_split:
+            splits.append("test")
+        elif folds > 0:
+            fold = int((u - test_split) / (1 - test_split) * folds)
+            splits.append(f"fold{min(fold, folds - 1)}")
+        elif u < test_split + validation_split:
+            splits.append("val")
+        else:
+            splits.append("train")
+    return pd.DataFrame(
+        {
+            "filename": filenames,
+            "group": [keys[f] for f in filenames],
+            "split": splits,
+        }
+    )
+
+
+def make_splits(
+    args, sizes: pd.Series, filenames: List[str]
+) -> Dict[str, Set[str]]:
+    """
+    Split the files with the mode chosen in args, and write the split of
+    each file next to the chord pairs.
+
+    Returns:
+        Dict[str, Set[str]]: files of each split.
+    """
+    print("Grouping files by song...")
+    if args.split_mode == "hash":
+        known_files = []
+        known_splits = {}
+        for path in args.known_files:
+            known = pd.read_csv(
+                path, usecols=lambda c: c in ("filename", "split")
+            )
+            if "split" in known.columns:
+                # splits.csv of a previous run: its files keep their split
+                known_splits.update(zip(known["filename"], known["split"]))
+            else:
+                known_files.extend(known["filename"].unique())
+        assignment = hash_split(
+            filenames,
+            args.test_split,
+            args.validation_split,
+            args.folds,
+            known_files,
+            known_splits,
+        )
+        splits = {name: set() for name in hash_split_names(args.folds)}
+        for f, split in zip(assignment["filename"], assignment["split"]):
+            splits[split].add(f)
+    else:
+        total_size = sizes.sum()
+        splits = dict(
+            zip(
+                ("test", "val", "train"),
+                split_by_song(
+                    sizes,
+                    filenames,
+                    total_size * args.test_split,
+                    total_size * args.validation_split,
+                ),
+            )
+        )
+        assignment = pd.DataFrame(
+            [
+                (f, name)
+                for name, files in splits.items()
+                for f in sorted(files)
+            ],
+            columns=["filename", "split"],
+        )
+    outpath = pathlib.Path(args.outfile)
+    assignment.to_csv(outpath.with_stem(args.out_prefix + "splits"))
+    return splits
+
+
+def source_paths(sourcefiles: str) -> List[pathlib.Path]:
+    sourcefiles = pathlib.Path(sourcefiles)
+    return [
+        f
+        for f in itertools.chain(
+            sourcefiles.glob("*.csv"), sourcefiles.glob("*.parquet")
+        )
+        if f.name != MANIFEST_NAME
+    ]
+
+
+def _rechunk(
+    frames: Iterable[pd.DataFrame], chunk_size: int
+) -> Iterator[pd.DataFrame]:
+    """
+    Gather small frames (e.g. one per track) into chunks of about chunk_size
+    rows, indexed like if all frames had been concatenated.
+    """
+    buffer = []
+    buffered = 0
+    offset = 0
+    for frame in frames:
+        buffer.append(frame)
+        buffered += len(frame)
+        if buffered >= chunk_size:
+            chunk = pd.concat(buffer, ignore_index=True)
+            chunk.index += offset
+            offset += len(chunk)
+            yield chunk
+            buffer = []
+            buffered = 0
+    if buffer:
+        chunk = pd.concat(buffer, ignore_index=True)
+        chunk.index += offset
+        yield chunk
+
+
+def _complete_files(
+    chunks: Iterable[pd.DataFrame], column: str
+) -> Iterator[pd.DataFrame]:
+    """
+    Move the rows of the last file of each chunk to the next chunk, so that
+    the rows of a file are never split across two chunks. The rows of a file
+    must be contiguous.
+    """
+    rest = None
+    for chunk in chunks:
+        if rest is not None:
+            chunk = pd.concat([rest, chunk])
+        if len(chunk) == 0:
+            continue
+        other = (chunk[column] != chunk[column].iloc[-1]).to_numpy()
+        # Start of the rows of the last file
+        start = len(chunk) - np.argmax(other[::-1]) if other.any() else 0
+        if start > 0:
+            yield chunk.iloc[:start]
+        rest = chunk.iloc[start:]
+    if rest is not None and len(rest) > 0:
+        yield rest
+
+
+def _write_chunk(df: pd.DataFrame, path: pathlib.Path, first: bool) -> None:
+    df.to_csv(path, mode="w" if first else "a", header=first)
+
+
+def stream_pairs(
+    frames: Iterable[pd.DataFrame],
+    outpath: pathlib.Path,
+    outpath_occ: pathlib.Path,
+    outpath_unique: pathlib.Path,
+    chunk_size: int = CHUNK_SIZE,
+    pack_diagrams: bool = False,
+) -> Tuple[pd.Series, List[str]]:
+    """
+    Make the pairs of a corpus chunk by chunk, appending them to the output
+    files as soon as they are computed. Pairs and chord occurences are only
+    duplicates within one file, so the deduplication is done per chunk.
+    Files are kept in their order of appearance.
+
+    Returns:
+        Tuple[pd.Series, List[str]]: number of unique pairs of each file
+        (files without pairs are left out, like in the in-memory mode) and
+        all the files of the corpus in their order of appearance.
+    """
+    sizes = {}
+    seen = set()
+    all_files = []
+    first = True
+    pair_offset = 0
+    occ_offset = 0
+    chunks = _complete_files(_rechunk(frames, chunk_size), "File")
+    for chunk in tqdm(chunks):
+        filenames = chunk["File"].unique()
+        repeated = [f for f in filenames if f in seen]
+        all_files.extend(f for f in filenames if f not in seen)
+        seen.update(filenames)
+        if repeated:
+            print(
+                f"{len(repeated)} files appear in several places, their "
+                "duplicates may not all be removed."
+            )
+        out_df, out_chord_occ = make_pairs(chunk, filenames)
+        if pack_diagrams:
+            out_df = pack_positions(out_df)
+            out_chord_occ = pack_positions(out_chord_occ)
+        out_df.index += pair_offset
+        out_chord_occ.index += occ_offset
+        pair_offset += len(out_df)
+        occ_offset += len(out_chord_occ)
+        out_df_unique = out_df.drop_duplicates(subset=UNIQUE_SUBSET)
+        _write_chunk(out_df, outpath, first)
+        _write_chunk(out_chord_occ.drop_duplicates(), outpath_occ, first)
+        _write_chunk(out_df_unique, outpath_unique, first)
+        first = False
+        for f, n in out_df_unique["filename"].value_counts(sort=False).items():
+            sizes[f] = sizes.get(f, 0) + n
+    if first:
+        _write_chunk(pd.DataFrame(columns=OUT_COLUMNS), outpath, first)
+        _write_chunk(
+            pd.DataFrame(columns=CHORDOCC_COLUMNS), outpath_occ, first
+        )
+        _write_chunk(pd.DataFrame(columns=OUT_COLUMNS), outpath_unique, first)
+    return pd.Series(sizes, dtype=int), all_files
+
+
+def _read_chunks(path: pathlib.Path, chunk_size: int):
+    # Cells are kept as written, so that they are copied unchanged
+    return pd.read_csv(
+        path,
+        index_col=0,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_size,
+    )
+
+
+def stream_unique(
+    chordpairs: pathlib.Path,
+    outpath_unique: pathlib.Path,
+    chunk_size: int = CHUNK_SIZE,
+) -> pd.Series:
+    """
+    Deduplicate precomputed pairs chunk by chunk.
+
+    Returns:
+        pd.Series: number of unique pairs of each file.
+    """
+    sizes = {}
+    first = True
+    chunks = _complete_files(_read_chunks(chordpairs, chunk_size), "filename")
+    for chunk in chunks:
+        out_df_unique = chunk.drop_duplicates(subset=UNIQUE_SUBSET)
+        _write_chunk(out_df_unique, outpath_unique, first)
+        first = False
+        for f, n in out_df_unique["filename"].value_counts(sort=False).items():
+            sizes[f] = sizes.get(f, 0) + n
+    if first:
+        _write_chunk(pd.DataFrame(columns=OUT_COLUMNS), outpath_unique, first)
+    return pd.Series(sizes, dtype=int)
+
+
+def stream_split(
+    inpath: pathlib.Path,
+    outpaths: List[pathlib.Path],
+    splits: Sequence[Set[str]],
+    chunk_size: int = CHUNK_SIZE,
+) -> List[int]:
+    """
+    Copy the rows of inpath to one file per split, chunk by chunk.
+
+    Returns:
+        List[int]: number of rows of each split.
+    """
+    lengths = [0] * len(splits)
+    for chunk in _read_chunks(inpath, chunk_size):
+        for k, (files, outpath) in enumerate(zip(splits, outpaths)):
+            split_chunk = chunk[chunk["filename"].isin(files)]
+            split_chunk.index = pd.RangeIndex(
+                lengths[k], lengths[k] + len(split_chunk)
+            )
+            _write_chunk(split_chunk, outpath, lengths[k] == 0)
+            lengths[k] += len(split_chunk)
+    for k, outpath in enumerate(outpaths):
+        if lengths[k] == 0:
+            # Only the header
+            _write_chunk(
+                pd.DataFrame(columns=pd.read_csv(inpath, nrows=0).columns[1:]),
+                outpath,
+                True,
+            )
+    return lengths
+
+
+def run_streaming(args) -> int:
+    """
+    Same as main, without ever loading the whole corpus: the sources, pairs
+    and chord occurences are read and written by chunks of rows. Only the
+    names and number of pairs of the files are kept in memory. Files are
+    not shuffled before making the pairs.
+    """
+    outpath = pathlib.Path(args.outfile)
+    outpath_occ = pathlib.Path(args.chordocc)
+    outpath_unique = outpath.with_stem("chord_pairs_unique")
+    if not args.chordpairs:
+        if args.sourcefile:
+            frames = iter_chord_table(args.sourcefile, args.chunk_size)
+        else:
+            frames = (
+                frame
+                for f in source_paths(args.sourcefiles)
+                for frame in iter_chord_table(f, args.chunk_size)
+            )
+        sizes, all_files = stream_pairs(
+            frames,
+            outpath,
+            outpath_occ,
+            outpath_unique,
+            args.chunk_size,
+            args.pack_diagrams,
+        )
+        # Same random draws as the in-memory mode, which shuffles all the
+        # files before making the pairs, so that both give the same splits
+        random.shuffle(all_files)
+        order = {f: i for i, f in enumerate(all_files)}
+        sizes = sizes.iloc[np.argsort([order[f] for f in sizes.index])]
+    else:
+        sizes = stream_unique(args.chordpairs, outpath_unique, args.chunk_size)
+    # Train/Validation/Test Split
+    filenames = list(sizes.index)
+    random.shuffle(filenames)
+    splits = make_splits(args, sizes, filenames)
+    lengths = stream_split(
+        outpath_unique,
+        [
+            outpath.with_stem(args.out_prefix + f"{n}_chordpairs")
+            for n in splits
+        ],
+        list(splits.values()),
+        args.chunk_size,
+    )
+    stream_split(
+        outpath_occ,
+        [
+            outpath_occ.with_stem(args.out_prefix + f"{n}_chordocc")
+            for n in splits
+        ],
+        list(splits.values()),
+        args.chunk_size,
+    )
+    print(f"Total size is {sizes.sum()}")
+    for name, length in zip(splits, lengths):
+        print(f"{SPLIT_NAMES.get(name, name)} set has {length} samples.")
+    return 0
 
 
 def main(parser: ArgumentParser) -> int:
     args = parser.parse_args()
+    if args.folds > 0 and args.split_mode != "hash":
+        parser.error("--folds requires --split-mode hash")
     random.seed(args.random_seed)
+    if args.streaming:
+        return run_streaming(args)
     if not args.chordpairs:
+        # Chords and Shapes are read as lists, from .csv or .parquet files
         if args.sourcefile:
-            df = pd.read_csv(args.sourcefile, index_col=0)
+            df = read_chord_table(args.sourcefile)
         else:
             df = pd.DataFrame(columns=IN_COLUMNS)
             to_concat = []
-            for f in tqdm(pathlib.Path(args.sourcefiles).glob("*.csv")):
-                subdf = pd.read_csv(f, index_col=0)
+            for f in tqdm(source_paths(args.sourcefiles)):
+                subdf = read_chord_table(f)
                 to_concat.append(subdf)
             df = pd.concat([df] + to_concat, ignore_index=True)
-        df["Chords"] = df["Chords"].apply(ast.literal_eval)
-        df["Shapes"] = df["Shapes"].apply(ast.literal_eval)
-        out_df = pd.DataFrame(columns=OUT_COLUMNS)
-        out_chord_occ = pd.DataFrame(columns=CHORDOCC_COLUMNS)
         filenames = df["File"].unique()
         random.shuffle(filenames)
-        for file in filenames:
-            print(file)
-            tmp_df, tmp_chord_occ = process_subdf(df[df["File"] == file])
-            if tmp_df is not None:
-                out_df = pd.concat([out_df, tmp_df], ignore_index=True)
-                out_chord_occ = pd.concat(
-                    [out_chord_occ, tmp_chord_occ], ignore_index=True
-                )
+        # All files at once, in the shuffled order
+        out_df, out_chord_occ = make_pairs(df, filenames)
+        if args.pack_diagrams:
+            out_df = pack_positions(out_df)
+            out_chord_occ = pack_positions(out_chord_occ)
         out_chord_occ = out_chord_occ.drop_duplicates()
         out_df.to_csv(args.outfile)
         out_chord_occ.to_csv(args.chordocc)
     else:
         out_df = pd.read_csv(args.chordpairs, index_col=0)
         out_chord_occ = pd.read_csv(args.chordocc, index_col=0)
-    out_df_unique = out_df.drop_duplicates(
-        subset=[
-            "filename",
-            "current_position",
-            "current_chord",
-            "next_position",
-            "next_chord",
-        ]
-    )
+    out_df_unique = out_df.drop_duplicates(subset=UNIQUE_SUBSET)
     outpath = pathlib.Path(args.outfile)
     outpath_occ = pathlib.Path(args.chordocc)
     out_df_unique.to_csv(outpath.with_stem("chord_pairs_unique"))
     # Train/Validation/Test Split
     total_size = len(out_df_unique)
-    test_size = total_size * args.test_split
-    validation_size = total_size * args.validation_split
     filenames = out_df_unique["filename"].unique()
     filenames = list(filenames)
     random.shuffle(filenames)
-    test_df = pd.DataFrame(columns=OUT_COLUMNS)
-    val_df = pd.DataFrame(columns=OUT_COLUMNS)
-    train_df = pd.DataFrame(columns=OUT_COLUMNS)
-    test_occ = pd.DataFrame(columns=CHORDOCC_COLUMNS)
-    val_occ = pd.DataFrame(columns=CHORDOCC_COLUMNS)
-    train_occ = pd.DataFrame(columns=CHORDOCC_COLUMNS)
-    f = 0
-    print("Building test set...")
-    while len(test_df) < test_size:
-        filename = filenames[f]
-        if filename in test_df["filename"].values:
-            f += 1
-            continue
-        f_to_add = [filename]
-        for f2 in filenames:
-            if f2 == filename:
-                continue
-            if filenames_match(filename, f2):
-                f_to_add.append(f2)
-        for fn in f_to_add:
-            test_df = pd.concat(
-                [test_df, out_df_unique[out_df_unique["filename"] == fn]],
-                ignore_index=True,
-            )
-            test_occ = pd.concat(
-                [test_occ, out_chord_occ[out_chord_occ["filename"] == fn]],
-                ignore_index=True,
-            )
-        f += 1
-    print("Building val set...")
-    while len(val_df) < validation_size:
-        filename = filenames[f]
-        if (
-            filename in val_df["filename"].values
-            or filename in test_df["filename"].values
-        ):
-            f += 1
-            continue
-        f_to_add = [filename]
-        for f2 in filenames:
-            if f2 == filename or f2 in test_df["filename"].values:
-                continue
-            if filenames_match(filename, f2):
-                f_to_add.append(f2)
-        for fn in f_to_add:
-            val_df = pd.concat(
-                [val_df, out_df_unique[out_df_unique["filename"] == fn]],
-                ignore_index=True,
-            )
-            test_occ = pd.concat(
-                [test_occ, out_chord_occ[out_chord_occ["filename"] == fn]],
-                ignore_index=True,
-            )
-        f += 1
-    print("Finishing with train set...")
-    while f < len(filenames):
-        filename = filenames[f]
-        if (
-            filename in train_df["filename"].values
-            or filename in val_df["filename"].values
-            or filename in test_df["filename"].values
-        ):
-            f += 1
-            continue
-        f_to_add = [filename]
-        for f2 in filenames:
-            if (
-                f2 == filename
-                or f2 in test_df["filename"].values
-                or f2 in val_df["filename"].values
-            ):
-                continue
-            if filenames_match(filename, f2):
-                f_to_add.append(f2)
-        for fn in f_to_add:
-            train_df = pd.concat(
-                [train_df, out_df_unique[out_df_unique["filename"] == fn]],
-                ignore_index=True,
-            )
-            test_occ = pd.concat(
-                [test_occ, out_chord_occ[out_chord_occ["filename"] == fn]],
-                ignore_index=True,
-            )
-        f += 1
+    splits = make_splits(
+        args, out_df_unique["filename"].value_counts(), filenames
+    )
+    split_dfs = {
+        name: out_df_unique[out_df_unique["filename"].isin(files)].reset_index(
+            drop=True
+        )
+        for name, files in splits.items()
+    }
+    split_occs = {
+        name: out_chord_occ[out_chord_occ["filename"].isin(files)].reset_index(
+            drop=True
+        )
+        for name, files in splits.items()
+    }
     # write everything to disk now
     print(f"Total size is {total_size}")
-    print(f"Test set has {len(test_df)} samples.")
-    print(f"Validation set has {len(val_df)} samples.")
-    print(f"Training set has {len(train_df)} samples.")
+    for name, split_df in split_dfs.items():
+        print(
+            f"{SPLIT_NAMES.get(name, name)} set has {len(split_df)} samples."
+        )
     print("Checking sets validity")
-    for f in test_df["filename"].unique():
-        if f in val_df["filename"].values or f in train_df["filename"].values:
+    for files, other_files in itertools.combinations(splits.values(), 2):
+        for f in files & other_files:
             print(f"{f} is also seen in other sets...")
-    for f in val_df["filename"].unique():
-        if f in train_df["filename"].values:
-            print(f"{f} is also seen in train set...")
-    test_df.to_csv(outpath.with_stem(args.out_prefix + "test_chordpairs"))
-    val_df.to_csv(outpath.with_stem(args.out_prefix + "val_chordpairs"))
-    train_df.to_csv(outpath.with_stem(args.out_prefix + "train_chordpairs"))
-    test_occ.to_csv(outpath_occ.with_stem(args.out_prefix + "test_chordocc"))
-    val_occ.to_csv(outpath_occ.with_stem(args.out_prefix + "val_chordocc"))
-    train_occ.to_csv(outpath_occ.with_stem(args.out_prefix + "train_chordocc"))
+    for name in splits:
+        split_dfs[name].to_csv(
+            outpath.with_stem(args.out_prefix + f"{name}_chordpairs")
+        )
+        split_occs[name].to_csv(
+            outpath_occ.with_stem(args.out_prefix + f"{name}_chordocc")
+        )
     return 0
 
 
@@ -341,14 +698,14 @@ if __name__ == "__main__":
         "--sourcefile",
         "-s",
         type=str,
-        help="Path to the source file with chord info.",
+        help="Path to the source file with chord info (.csv or .parquet).",
     )
     parser.add_argument(
         "--sourcefiles",
         "-S",
         type=str,
         default="/home/alexandre/PhD/data/DadaGP-chordcsv/",
-        help="Path to separate csv files. Useful for huge datasets like DadaGP.",
+        help="Path to separate .csv or .parquet files. Useful for huge datasets like DadaGP.",
     )
     parser.add_argument(
         "--chordpairs",
@@ -395,4 +752,40 @@ if __name__ == "__main__":
         default=2222,
         help="Random seed for train_test_split",
     )
+    parser.add_argument(
+        "--split-mode",
+        type=str,
+        choices=SPLIT_MODES,
+        default="random",
+        help="random: shuffle the songs and fill the test, validation and train sets in turn. hash: assign each song from a hash of its name, so that the split doesn't change when files are added.",
+    )
+    parser.add_argument(
+        "--folds",
+        type=int,
+        default=0,
+        help="With --split-mode hash, split the files that are not in the test set in that many folds instead of validation and train sets.",
+    )
+    parser.add_argument(
+        "--known-files",
+        type=str,
+        nargs="*",
+        default=[],
+        help="With --split-mode hash, .csv files with a filename column whose files are used to group songs. Files of a splits.csv of a previous run (with a split column) keep their split, and new files that join their songs take it.",
+    )
+    parser.add_argument(
+        "--pack-diagrams",
+        action="store_true",
+        help="Write diagrams as packed integers instead of strings (see packed_diagrams.py).",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read and write everything by chunks of rows, for corpora that don't fit in memory.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Number of rows read at once in streaming mode.",
+    )
     sys.exit(main(parser))
@@ -0,0 +1,80 @@
+"""
+Compact encoding of chord diagrams: the fret of each string (or mute) on 5
+bits, the 6 strings packed in one int32. String i is stored in bits
+5*i to 5*i+4, muted strings as MUTE_CODE. Equal diagrams have equal codes,
+so diagrams can be compared, sorted or deduplicated as integers.
+
+Only depends on numpy, so that the data scripts can use it as well.
+"""
+
+from typing import Iterable, List
+
+import numpy as np
+import pandas as pd
+
+BITS_PER_STRING = 5
+MUTE_CODE = 2**BITS_PER_STRING - 1
+# Same as cds.config
+NUM_STRINGS = 6
+NUM_FRETS = 24
+MUTED = -1
+STRING_SHIFTS = BITS_PER_STRING * np.arange(NUM_STRINGS, dtype=np.int32)
+
+
+def pack_frets(frets: np.ndarray) -> np.ndarray:
+    """
+    Pack frets (..., NUM_STRINGS), MUTED for muted strings, into int32 codes.
+    """
+    frets = np.asarray(frets)
+    if frets.shape[-1] != NUM_STRINGS:
+        raise ValueError(f"Diagrams must have {NUM_STRINGS} strings.")
+    # Like shape_to_manyhot, frets must fit in the fretboard
+    if ((frets < MUTED) | (frets >= NUM_FRETS)).any():
+        raise ValueError(f"Frets must be between 0 and {NUM_FRETS - 1}.")
+    values = np.where(frets == MUTED, MUTE_CODE, frets).astype(np.int32)
+    # Bits of different strings don't overlap, the sum is a bitwise or
+    return (values << STRING_SHIFTS).sum(axis=-1, dtype=np.int32)
+
+
+def unpack_frets(codes: np.ndarray) -> np.ndarray:
+    """
+    Frets (..., NUM_STRINGS) of int32 codes, MUTED for muted strings.
+    """
+    values = (
+        np.asarray(codes, dtype=np.int32)[..., None] >> STRING_SHIFTS
+    ) & MUTE_CODE
+    return np.where(values == MUTE_CODE, MUTED, values)
+
+
+def _shape_frets(shape: str) -> List[int]:
+    frets = [MUTED if f == "x" else int(f) for f in shape.split(".")]
+    if len(frets) != NUM_STRINGS:
+        raise ValueError(f"{shape} doesn't have {NUM_STRINGS} strings.")
+    return frets
+
+
+def pack_shapes(shapes: Iterable[str]) -> np.ndarray:
+    """
+    Codes of diagrams written as strings (e.g. 'x.3.2.0.1.0'), each distinct
+    string being parsed once.
+    """
+    codes, unique_shapes = pd.factorize(pd.Series(list(shapes), dtype=object))
+    frets = np.array(
+        [_shape_frets(s) for s in unique_shapes], dtype=np.int64
+    ).reshape(-1, NUM_STRINGS)
+    return pack_frets(frets)[codes]
+
+
+def unpack_shapes(codes: Iterable[int]) -> List[str]:
+    """
+    Diagrams of codes as strings, each distinct code being formatted once.
+    """
+    inverse, unique_codes = pd.factorize(pd.Series(np.asarray(codes)))
+    shapes = np.array(
+        [
+            ".".join("x" if f == MUTED else str(f) for f in frets)
+            for frets in unpack_frets(np.asarray(unique_codes))
+        ],
+        dtype=object,
+    )
+    return list(shapes[inverse])
@@ -1,18 +1,24 @@
 import weakref
 import xml.etree.ElementTree as ET
+from typing import Dict, Tuple
 
 from music21 import *
 from music21.base import ElementWrapper
 
+from chord_diagrams import get_diagram_collection, get_id2name, get_root
 from hammeron_pulloff import Hammer_on, Pull_off
 
 # TODO Ecrire des commentaire python typique
 
+# Bump when the scores built by ParserGP change, to invalidate the scores
+# cached by score_cache.ScoreCache
+PARSER_VERSION = 1
+
 
 class ParserGP(converter.subConverters.SubConverter):
 
     registerFormats = ("gpif",)
-    registerInputExtensions = ("gpif",)
+    registerInputExtensions = ("gpif", "gp")
 
     @staticmethod
     def _make_metronomeMark(tempo_value: str) -> tempo.MetronomeMark:
@@ -28,15 +34,45 @@ class ParserGP(converter.subConverters.SubConverter):
         #     xml_tree = ET.parse(xml_file)
         #     self.root = xml_tree.getroot()
         #     self.__initScore())
+        # .gp archives are read in memory, without unzipping them to disk
+        return self.parseRoot(get_root(XMLFileName))
+
+    # Same as parseFile, from an already parsed GPIF root
+    def parseRoot(self, root):
         # Reset self.stream for each file
         self.stream = stream.Score()
         # List to store all Hammer-Ons and Pull-Offs (hopos)
         self.hopos = []
         self.notes_with_slide_to_next = []
-        self.root = ET.parse(XMLFileName).getroot()
+        self.root = root
+        self.__indexElements()
         self.__initScore()
         return self.stream
 
+    @staticmethod
+    def _index_by_id(elements) -> dict:
+        # Keep the first element for each id, like an XPath [@id='...'] lookup would
+        index = {}
+        for element in elements:
+            index.setdefault(element.get("id"), element)
+        return index
+
+    # Build id -> element dictionaries once, so that lookups during parsing
+    # do not scan the whole document for every beat and note
+    def __indexElements(self):
+        self.bars = self._index_by_id(self.root.iterfind("./Bars/Bar"))
+        self.voices = self._index_by_id(self.root.iterfind("./Voices/Voice"))
+        self.beats = self._index_by_id(self.root.iterfind("./Beats/Beat"))
+        self.notes = self._index_by_id(self.root.iterfind("./Notes/Note"))
+        self.rhythms = self._index_by_id(
+            self.root.iterfind("./Rhythms/Rhythm")
+        )
+        self.diagram_items = self._index_by_id(
+            self.root.iterfind(
+                "./Tracks/Track/Staves/Staff/Properties/Property[@name='DiagramCollection']/Items/Item"
+            )
+        )
+
     # Create a Stream structure (Score > Part > Measure > Voice > Notes) according to xml
     def __initScore(self):
         # Set Score metadatas
@@ -192,8 +228,9 @@ class ParserGP(converter.subConverters.SubConverter):
         # Append Voices into previously created measure
         for i in range(len(partTab)):
             for j in range(len(partTab[i])):
-                simileMark = self.root.find(
-                    "./Bars/Bar[@id='" + partTab[i][j].id + "']/SimileMark"
+                barXML = self.bars.get(partTab[i][j].id)
+                simileMark = (
+                    barXML.find("./SimileMark") if barXML is not None else None
                 )
                 if simileMark is not None:
                     # if there is a simile mark we go back to the previous measure element
@@ -212,8 +249,8 @@ class ParserGP(converter.subConverters.SubConverter):
                             partTab[i][j].append(v)
                 else:
                     # When there is no simile mark we fetch voices in XML file
-                    for voices in self.root.findall(
-                        "./Bars/Bar[@id='" + partTab[i][j].id + "']/Voices"
+                    for voices in (
+                        barXML.findall("./Voices") if barXML is not None else []
                     ):
                         for index, idVoice in enumerate(voices.text.split()):
                             # Voice is a list of 4 ids where -1 means there is no voice
@@ -317,55 +354,42 @@ class ParserGP(converter.subConverters.SubConverter):
             for j in range(len(partTab[i])):
                 for v, voice in enumerate(partTab[i][j].voices):
                     offset = 0.0
-                    beats = self.root.findall(
-                        "./Voices/Voice[@id='" + str(voice.idGpif) + "']/Beats"
+                    voiceXML = self.voices.get(str(voice.idGpif))
+                    beats = (
+                        voiceXML.findall("./Beats") if voiceXML is not None else []
                     )
                     if len(beats):
                         # Browse all beats in the voice
                         for idBeat in beats[0].text.split():
-                            notesEl = self.root.findall(
-                                "./Beats/Beat[@id='" + idBeat + "']/Notes"
-                            )
-                            cXML = self.root.findall(
-                                "./Beats/Beat[@id='" + idBeat + "']/Chord"
-                            )
+                            beatXML = self.beats.get(idBeat)
+                            if beatXML is None:
+                                # Unknown beat id, behave as an empty beat
+                                beatXML = ET.Element("Beat")
+                            notesEl = beatXML.findall("./Notes")
+                            cXML = beatXML.findall("./Chord")
 
                             """"""
                             #
-                            legato = self.root.find(
-                                "./Beats/Beat[@id='" + idBeat + "']/Legato"
-                            )
+                            legato = beatXML.find("./Legato")
                             if legato != None:
                                 val_origin = legato.get(
                                     "origin"
                                 )  # val_origin/desination : str -> 'true' ou 'false'
                                 val_destination = legato.get("destination")
 
-                            fun = self.root.find(
-                                "./Beats/Beat[@id='" + idBeat + "']/FreeText"
-                            )
+                            fun = beatXML.find("./FreeText")
 
-                            VibratoWTremBar = self.root.find(
-                                "./Beats/Beat[@id='"
-                                + idBeat
-                                + "']/Properties/Property[@name='VibratoWTremBar']"
-                            )
-                            Whammy = self.root.find(
-                                "./Beats/Beat[@id='" + idBeat + "']/Whammy"
+                            VibratoWTremBar = beatXML.find(
+                                "./Properties/Property[@name='VibratoWTremBar']"
                             )
+                            Whammy = beatXML.find("./Whammy")
 
                             chordName = None
-                            graceXML = self.root.findall(
-                                "./Beats/Beat[@id='" + idBeat + "']/GraceNotes"
-                            )
+                            graceXML = beatXML.findall("./GraceNotes")
                             c = None
                             if len(cXML):  # GESTION DES LYRICS POUR LES CHORDS
                                 idChord = cXML[0].text
-                                chordName = self.root.find(
-                                    "./Tracks/Track/Staves/Staff/Properties/Property[@name='DiagramCollection']/Items/Item[@id='"
-                                    + idChord
-                                    + "']"
-                                ).get("name")
+                                chordName = self.diagram_items[idChord].get("name")
 
                             if len(notesEl):
                                 idNotes = notesEl[0].text.split()
@@ -376,40 +400,27 @@ class ParserGP(converter.subConverters.SubConverter):
                                 slide = None
                                 mute = None
                                 for idNote in idNotes:
+                                    noteXML = self.notes[idNote]
 
                                     """"""
                                     """BOUT DE CODE RECUPERATION DE LET-RING, LIAISONS (legato gp)
                                     ,INDICATEURS DE MESURES SOLO ou ACCOMPAGNEMENT(RYTHMIQUE), BEND ..."""
                                     #
                                     if lr == None:
-                                        lr = self.root.find(
-                                            "./Notes/Note[@id='"
-                                            + idNote
-                                            + "']/LetRing"
-                                        )
+                                        lr = noteXML.find("./LetRing")
                                     if vibwide == None:
-                                        vibwide = self.root.find(
-                                            "./Notes/Note[@id='"
-                                            + idNote
-                                            + "']/Vibrato"
-                                        )
+                                        vibwide = noteXML.find("./Vibrato")
 
                                     if bend == None:
-                                        bend = self.root.find(
-                                            "./Notes/Note[@id='"
-                                            + idNote
-                                            + "']/Properties/Property[@name='Bended']/Enable"
+                                        bend = noteXML.find(
+                                            "./Properties/Property[@name='Bended']/Enable"
                                         )
 
                                     ####################################
                                     ####################################
 
                                     if slide == None:
-                                        slide = self.root.find(
-                                            "./Notes/Note[@id='"
-                                            + idNote
-                                            + "']/Slide"
-                                        )
+                                        slide = noteXML.find("./Slide")
 
                                     ####################################
                                     ####################################
@@ -423,20 +434,16 @@ class ParserGP(converter.subConverters.SubConverter):
                                     Notelr.addLyric(
                                         "ST"
                                         + str(
-                                            self.root.find(
-                                                "./Notes/Note[@id='"
-                                                + idNote
-                                                + "']/Properties/Property[@name='String']/String"
+                                            noteXML.find(
+                                                "./Properties/Property[@name='String']/String"
                                             ).text
                                         )
                                     )
                                     Notelr.addLyric(
                                         "FR"
                                         + str(
-                                            self.root.find(
-                                                "./Notes/Note[@id='"
-                                                + idNote
-                                                + "']/Properties/Property[@name='Fret']/Fret"
+                                            noteXML.find(
+                                                "./Properties/Property[@name='Fret']/Fret"
                                             ).text
                                         )
                                     )
@@ -558,9 +565,8 @@ class ParserGP(converter.subConverters.SubConverter):
         # Pitch
         # pitch = self.root.find("./Notes/Note[@id='" + idNote + "']/Properties/Property[@name='ConcertPitch']/Pitch")
         # n = note.Note(self.__getPitchFromXML(pitch))
-        note_properties = self.root.find(
-            "./Notes/Note[@id='" + idNote + "']/Properties"
-        )
+        noteXML = self.notes[idNote]
+        note_properties = noteXML.find("./Properties")
         midiPitch = note_properties.find("Property[@name='Midi']/Number").text
         # midiPitch = self.root.find("./Notes/Note[@id='" + idNote + "']/Properties/Property[@name='Midi']/Number").text
         n = note.Note(int(midiPitch))
@@ -627,20 +633,10 @@ class ParserGP(converter.subConverters.SubConverter):
 
         tie_start = False
         tie_stop = False
-        if (
-            self.root.findall(
-                "./Notes/Note[@id='" + idNote + "']/Tie[@origin='true']"
-            )
-            != []
-        ):
+        if noteXML.findall("./Tie[@origin='true']") != []:
             tie_start = True
 
-        if (
-            self.root.findall(
-                "./Notes/Note[@id='" + idNote + "']/Tie[@destination='true']"
-            )
-            != []
-        ):
+        if noteXML.findall("./Tie[@destination='true']") != []:
             tie_stop = True
 
         if tie_start and tie_stop:
@@ -652,11 +648,7 @@ class ParserGP(converter.subConverters.SubConverter):
 
         # Add String as an Articulation
         gpif_string_number = int(
-            self.root.find(
-                "./Notes/Note[@id='"
-                + idNote
-                + "']/Properties/Property[@name='String']/String"
-            ).text
+            noteXML.find("./Properties/Property[@name='String']/String").text
         )
         standard_string_number = (
             -1
@@ -673,24 +665,12 @@ class ParserGP(converter.subConverters.SubConverter):
         fret = articulations.FretIndication()
         # fret.number = str(int(self.root.find("./Notes/Note[@id='" + idNote + "']/Properties/Property[@name='Fret']/Fret").text) + additionalSemiTone)
         fret.number = int(
-            self.root.find(
-                "./Notes/Note[@id='"
-                + idNote
-                + "']/Properties/Property[@name='Fret']/Fret"
-            ).text
+            noteXML.find("./Properties/Property[@name='Fret']/Fret").text
         )
 
         # Detect if there is a Hammer-on or a Pull-off
-        hopo_start = self.root.find(
-            "./Notes/Note[@id='"
-            + idNote
-            + "']/Properties/Property[@name='HopoOrigin']"
-        )
-        hopo_end = self.root.find(
-            "./Notes/Note[@id='"
-            + idNote
-            + "']/Properties/Property[@name='HopoDestination']"
-        )
+        hopo_start = note_properties.find("Property[@name='HopoOrigin']")
+        hopo_end = note_properties.find("Property[@name='HopoDestination']")
 
         # Add articulations to note
         n.articulations = [string, fret]
@@ -785,12 +765,11 @@ class ParserGP(converter.subConverters.SubConverter):
     # Get Duration type of the rhythm of a specified beat
     def __getRythmDurationFromIdBeat(self, idBeat):
         d = duration.Duration()
-        rhythm = self.root.findall("./Beats/Beat[@id='" + idBeat + "']/Rhythm")
+        beatXML = self.beats.get(idBeat)
+        rhythm = beatXML.findall("./Rhythm") if beatXML is not None else []
         if len(rhythm):
             idRhythm = rhythm[0].get("ref")
-            rhythm = self.root.findall(
-                "./Rhythms/Rhythm[@id='" + idRhythm + "']"
-            )
+            rhythm = [self.rhythms[idRhythm]] if idRhythm in self.rhythms else []
             if len(rhythm):
                 noteValue = rhythm[0].find("NoteValue").text.lower()
                 dots = 0
@@ -825,3 +804,19 @@ class ParserGP(converter.subConverters.SubConverter):
     def writeGPFromStream(self, stream):
 
         return
+
+
+def parse_gpif(
+    XMLFileName, require_diagrams=False
+) -> Tuple[Dict, Dict, stream.Score | None]:
+    """
+    Parse a .gpif file only once and return its diagram collection, the
+    id -> name map of its diagrams and its music21 score. With
+    require_diagrams, the score is not built (None) if there is no diagram.
+    """
+    root = get_root(XMLFileName)
+    collection = get_diagram_collection(root)
+    id2name = get_id2name(root)
+    if require_diagrams and len(collection) == 0:
+        return collection, id2name, None
+    return collection, id2name, ParserGP().parseRoot(root)
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import pathlib
+import pickle
+import tempfile
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, Tuple
+
+from music21 import stream
+
+from gp_archive import open_gpif
+from parserGP import PARSER_VERSION, parse_gpif
+
+CACHE_SUFFIX = ".p"
+# Check the real size of the cache folder every so many writes, other
+# processes may be writing to it as well
+RESCAN_EVERY = 100
+
+
+class ScoreCache:
+    """
+    On-disk cache of parsed GPIF files.
+
+    Entries are keyed on the hash of the GPIF content and of the parser
+    version, so renamed or moved files are still found and any change to
+    ParserGP (bump PARSER_VERSION) invalidates old entries. Entries are
+    written atomically, so several processes can share the same folder.
+    When the folder grows over max_size bytes, the least recently used
+    entries are removed.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | pathlib.Path,
+        max_size: int = 10 * 2**30,
+        version: int | str = PARSER_VERSION,
+    ) -> None:
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.version = version
+        self._size = None
+        self._writes = 0
+
+    def key(self, content: bytes) -> str:
+        h = hashlib.sha256()
+        h.update(f"ParserGP-{self.version}".encode())
+        h.update(b"\0")
+        h.update(content)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.cache_dir / key[:2] / (key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Any | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Corrupted or outdated entry (e.g. pickled by another music21
+            # version, which can raise almost anything), it will be written
+            # again
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            # The modification time is used as last access time for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+        self._writes += 1
+        if self._size is None or self._writes % RESCAN_EVERY == 0:
+            self._size = self.size()
+        else:
+            self._size += path.stat().st_size
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        for path in self.cache_dir.glob("*/*" + CACHE_SUFFIX):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self._size = total
+
+
+def load_or_parse_gpif(
+    file, cache: ScoreCache | None = None, require_diagrams: bool = False
+) -> Tuple[Dict, Dict, stream.Score | None]:
+    """
+    Same as parserGP.parse_gpif, but the results are loaded from the cache
+    when the same GPIF content has already been parsed.
+    """
+    if cache is None:
+        return parse_gpif(file, require_diagrams=require_diagrams)
+    with open_gpif(file) as f:
+        content = f.read()
+    key = cache.key(content)
+    parsed = cache.get(key)
+    if parsed is not None and (parsed[2] is not None or require_diagrams):
+        return parsed
+    parsed = parse_gpif(
+        ET.fromstring(content), require_diagrams=require_diagrams
+    )
+    cache.put(key, parsed)
+    return parsed
@@ -1,5 +1,6 @@
 import torch
 from cds.config import NUM_FRETS, NUM_STRINGS
+from cds.data.packed_diagrams import BITS_PER_STRING, MUTE_CODE
 
 def shape_to_manyhot(shape: str,
         num_frets: int = NUM_FRETS, num_strings: int = NUM_STRINGS,
@@ -20,3 +21,31 @@ def shape_to_manyhot(shape: str,
                 raise ValueError(f"Fret {f} cannot be included in fretboard of size {num_frets}.")
             out[i][int(f)] = 1
     return out
+
+def packed_to_manyhot(codes: torch.Tensor,
+        num_frets: int = NUM_FRETS, num_strings: int = NUM_STRINGS,
+        with_mute: bool = False) -> torch.Tensor:
+    """
+    Same as shape_to_manyhot, for a tensor of packed diagrams (see
+    packed_diagrams.py). Returns a (..., num_strings, num_frets) tensor.
+    """
+    shifts = BITS_PER_STRING * torch.arange(num_strings, dtype=torch.int32)
+    values = (codes.to(torch.int32)[..., None] >> shifts) & MUTE_CODE
+    if ((values >= num_frets) & (values != MUTE_CODE)).any():
+        raise ValueError(f"Packed diagrams have frets that cannot be included in fretboard of size {num_frets}.")
+    out = values[..., None] == torch.arange(num_frets)
+    if with_mute:
+        out = torch.cat((out, (values == MUTE_CODE)[..., None]), dim=-1)
+    return out
+
+def manyhot_to_packed(manyhot: torch.Tensor,
+        with_mute: bool = False) -> torch.Tensor:
+    """
+    Packed diagrams of (..., num_strings, num_frets) many-hot tensors, strings
+    without any fret being muted.
+    """
+    frets = manyhot[..., :-1] if with_mute else manyhot
+    pressed = frets.any(dim=-1)
+    values = torch.where(pressed, frets.to(torch.uint8).argmax(dim=-1), MUTE_CODE)
+    shifts = BITS_PER_STRING * torch.arange(manyhot.shape[-2], dtype=torch.int32)
+    return (values.to(torch.int32) << shifts).sum(dim=-1, dtype=torch.int32)
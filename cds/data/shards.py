@@ -0,0 +1,88 @@
+"""
+Split a table of chord pairs into Parquet shards for ShardedDataset, e.g.
+
+    python -m cds.data.shards -i train_chordpairs.csv -o shards/train
+
+The rows of a file are never split across two shards, so that duplicates can
+be removed shard by shard. Diagrams are stored as packed integers (see
+packed_diagrams.py).
+"""
+import pathlib
+import sys
+from argparse import ArgumentParser
+from typing import List
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cds.data.packed_diagrams import pack_shapes
+
+SHARD_SIZE = 100_000
+SCHEMA = pa.schema([
+    ('filename', pa.string()),
+    ('measure', pa.float64()),
+    ('current_chord', pa.string()),
+    ('next_chord', pa.string()),
+    ('current_position', pa.int32()),
+    ('next_position', pa.int32()),
+])
+
+
+def _write_shard(df: pd.DataFrame, path: pathlib.Path):
+    columns = {}
+    for name in SCHEMA.names:
+        column = df[name]
+        if name in ['current_position', 'next_position'] \
+                and not pd.api.types.is_integer_dtype(column):
+            column = pack_shapes(column)
+        elif name in ['filename', 'current_chord', 'next_chord']:
+            column = column.astype(str)
+        columns[name] = np.asarray(column)
+    pq.write_table(pa.table(columns, schema=SCHEMA), path)
+
+
+def write_shards(df_path: str, out_dir: str,
+        shard_size: int = SHARD_SIZE) -> List[pathlib.Path]:
+    """
+    Write the rows of a chord pairs .csv file in shards of about shard_size
+    rows, without loading the whole file. The rows of a file must be
+    contiguous, which is the case in the tables of make_chord_pairs.py.
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    pending = None
+    for chunk in pd.read_csv(df_path, index_col=0, chunksize=shard_size):
+        pending = chunk if pending is None else pd.concat([pending, chunk])
+        if len(pending) < shard_size:
+            continue
+        # Rows of the last file go to the next shard
+        filenames = pending['filename'].to_numpy()
+        last_rows = np.cumprod(filenames[::-1] == filenames[-1]).sum()
+        if last_rows == len(pending):
+            continue
+        paths.append(out_dir / f'shard-{len(paths):05d}.parquet')
+        _write_shard(pending.iloc[:len(pending) - last_rows], paths[-1])
+        pending = pending.iloc[len(pending) - last_rows:]
+    if pending is not None and len(pending) > 0:
+        paths.append(out_dir / f'shard-{len(paths):05d}.parquet')
+        _write_shard(pending, paths[-1])
+    return paths
+
+
+def main(parser: ArgumentParser) -> int:
+    args = parser.parse_args()
+    paths = write_shards(args.input, args.output, args.shard_size)
+    print(f"Wrote {len(paths)} shards to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Split a chord pairs .csv file into Parquet shards.")
+    parser.add_argument('-i', '--input', type=str, required=True,
+            help="Chord pairs .csv file.")
+    parser.add_argument('-o', '--output', type=str, required=True,
+            help="Folder where the shards are written.")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+            help="Approximate number of rows of each shard.")
+    sys.exit(main(parser))
@@ -0,0 +1,160 @@
+"""
+Group the files that are tracks or versions of the same song, so that a song
+never ends up in two different splits.
+
+Two files belong to the same song when their names are similar (see
+names_match), and groups are the connected components of the matching
+pairs, found with union-find. Comparing every pair of names with
+SequenceMatcher is far too slow, so candidate pairs are first selected with
+the two upper bounds of the ratio used by SequenceMatcher itself: names are
+sorted by length and each name is only compared to names of compatible
+length (real_quick_ratio), and the number of characters they have in common
+(quick_ratio) is computed for all of them at once with numpy. No matching
+pair is missed, the groups are the same as when comparing every pair.
+
+Groups can also be given a key that does not depend on the order of the
+files (group_keys) and a position in [0, 1) computed from that key
+(stable_hash), which is the same on every machine and every run.
+"""
+
+import hashlib
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import List
+
+import numpy as np
+
+THRESHOLD = 0.8
+NUM_BINS = 8
+
+
+def normalize_name(name: str) -> str:
+    return "".join(c for c in name.upper() if c.isalnum())
+
+
+def lcs_length(n1: str, n2: str) -> int:
+    """
+    Length of the longest common subsequence, with the bit-parallel
+    algorithm of Allison and Dix: one bit per character of n1.
+    """
+    masks = {}
+    for i, c in enumerate(n1):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    all_ones = (1 << len(n1)) - 1
+    v = all_ones
+    for c in n2:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & all_ones
+    return len(n1) - bin(v).count("1")
+
+
+def names_match(n1: str, n2: str, t: float = THRESHOLD) -> bool:
+    """
+    Same as make_chord_pairs.filenames_match, for already normalized names.
+    """
+    # Cheap upper bounds of both ratios: the matching blocks found by
+    # SequenceMatcher are a common subsequence
+    if 2 * lcs_length(n1, n2) <= t * (len(n1) + len(n2)):
+        return False
+    matcher = SequenceMatcher(None, n1, n2)
+    if matcher.ratio() > t:
+        return True
+    matcher.set_seqs(n2, n1)
+    return matcher.ratio() > t
+
+
+def _find(parent: List[int], i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def song_groups(filenames: List[str], t: float = THRESHOLD) -> List[int]:
+    """
+    Returns:
+        List[int]: group id of each file, which is the index of the first
+            file of its group in filenames.
+    """
+    # Names are normalized once, identical names are compared once
+    names = [normalize_name(f) for f in filenames]
+    unique_names = list(dict.fromkeys(names))
+    name_ids = {name: i for i, name in enumerate(unique_names)}
+    lengths = np.array([len(name) for name in unique_names])
+    order = np.argsort(lengths, kind="stable")
+    sorted_lengths = lengths[order]
+    # Number of occurences of each character in each name
+    frequency = Counter("".join(unique_names))
+    alphabet = {c: k for k, (c, _) in enumerate(frequency.most_common())}
+    counts = np.zeros((len(unique_names), len(alphabet)), dtype=np.uint16)
+    for i, name in enumerate(unique_names):
+        for c, n in Counter(name).items():
+            counts[i, alphabet[c]] = n
+    counts = counts[order]
+    # Same with characters merged in a few bins, which gives an upper bound
+    # of the number of common characters that is much cheaper to compute
+    bins = np.arange(len(alphabet)) % NUM_BINS
+    binned_counts = np.zeros((len(unique_names), NUM_BINS), dtype=np.uint16)
+    for k in range(NUM_BINS):
+        binned_counts[:, k] = counts[:, bins == k].sum(axis=1)
+    parent = list(range(len(unique_names)))
+    for a, i in enumerate(order):
+        length = sorted_lengths[a]
+        # Longer names with 2 * length / (length + len(j)) > t
+        end = np.searchsorted(
+            sorted_lengths, length * (2 - t) / t + 1e-9, side="right"
+        )
+        common = np.minimum(binned_counts[a], binned_counts[a + 1 : end])
+        candidates = (
+            np.flatnonzero(
+                2 * common.sum(axis=1)
+                > t * (length + sorted_lengths[a + 1 : end])
+            )
+            + a
+            + 1
+        )
+        # quick_ratio
+        common = np.minimum(counts[a], counts[candidates])
+        candidates = candidates[
+            2 * common.sum(axis=1) > t * (length + sorted_lengths[candidates])
+        ]
+        for b in candidates:
+            j = order[b]
+            root_i = _find(parent, i)
+            root_j = _find(parent, j)
+            # Pairs already grouped are not compared again
+            if root_i == root_j:
+                continue
+            if names_match(unique_names[i], unique_names[j], t):
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+    # Group of each file, identified by its first file
+    first_file = {}
+    groups = []
+    for name in names:
+        root = _find(parent, name_ids[name])
+        groups.append(first_file.setdefault(root, len(groups)))
+    return groups
+
+
+def group_keys(filenames: List[str], t: float = THRESHOLD) -> List[str]:
+    """
+    Returns:
+        List[str]: key of the group of each file, which is the smallest
+            normalized name of the group. It only changes if a file with a
+            smaller name joins the group.
+    """
+    groups = song_groups(filenames, t)
+    keys = {}
+    for filename, group in zip(filenames, groups):
+        name = normalize_name(filename)
+        if group not in keys or name < keys[group]:
+            keys[group] = name
+    return [keys[group] for group in groups]
+
+
+def stable_hash(key: str) -> float:
+    """
+    Position of key in [0, 1). Unlike hash(), it doesn't change between runs.
+    """
+    digest = hashlib.sha1(key.encode()).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
@@ -9,6 +9,8 @@ from statistics import mean, stdev
 
 def main(parser: ArgumentParser) -> int:
     args = parser.parse_args()
+    if args.anatomical_table:
+        L.set_anatomical_table(args.anatomical_table)
     SOURCEPATH = pathlib.Path(args.sourcepath)
     if SOURCEPATH.is_dir():
         test_sets = list(SOURCEPATH.glob('*.csv'))
@@ -107,6 +109,8 @@ if __name__ == '__main__':
             help="Compute ratio on 'unplayable' diagrams.")
     parser.add_argument('--texture', action='store_true',
             help="Compute a set of texture related metrics.")
+    parser.add_argument('--anatomical-table', type=str,
+            help="Table of precomputed anatomical scores (see anatomical_scores-script.py), filled with new diagrams.")
     parser.add_argument('--strict', action='store_true',
             help="Drop duplicates from test set on filename, nextchord and nextposition.")
     parser.add_argument('--stricter', action='store_true',
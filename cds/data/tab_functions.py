@@ -1,10 +1,7 @@
 import copy
-import pickle
 
 from music21 import *
 
-from parserGP import ParserGP
-
 
 def stream_without_notes(str):
     chordified_stream = str.chordify()
@@ -15,19 +12,6 @@ def stream_without_notes(str):
     return False
 
 
-def parse_or_unpickle(file_name):
-    p_name = file_name.replace(".gp", "") + ".p"
-    if p_name in pickle_list:
-        print("unpicking {}".format(p_name))
-        str = pickle.load(open(pickled_streams_dir + "/" + p_name, "rb"))
-        return str
-    else:
-        print("parsing {}".format(file_name))
-        return ParserGP().parseFile(
-            gpif_dir + "/" + file_name.replace(".gp", "") + "/score.gpif"
-        )
-
-
 def note_equivalence(n1, n2):
     if n1 == n2 and n1.offset == n2.offset:
         return True
@@ -0,0 +1,100 @@
+"""
+On-disk table of the anatomical scores of diagrams (see
+losses.anatomical_score), keyed on the diagram string.
+
+The table is a SQLite database, so that several processes (test runs,
+DataLoader workers, the stats script) can read and fill the same file.
+Unlike ScoreCache, which stores one file per entry, the entries are tiny and
+there is one per distinct diagram of the corpus.
+"""
+import json
+import os
+import pathlib
+import sqlite3
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
+# Bump when anatomical_score changes, entries of other versions are ignored
+ANATOMICAL_SCORE_VERSION = 1
+# Seconds to wait for another process writing to the table
+TIMEOUT = 60
+
+Fingering = Dict[int, List[Tuple[int, int]]]
+
+
+def _dump_fingering(fingering: Fingering | None) -> str:
+    if fingering is None:
+        return 'null'
+    return json.dumps([[finger, sf_pairs] for finger, sf_pairs in fingering.items()])
+
+
+def _load_fingering(value: str) -> Fingering | None:
+    items = json.loads(value)
+    if items is None:
+        return None
+    # Same type as get_possible_fingerings returns
+    fingering = defaultdict(list)
+    for finger, sf_pairs in items:
+        fingering[finger] = [tuple(sf) for sf in sf_pairs]
+    return fingering
+
+
+class AnatomicalTable:
+    """
+    Scores and best fingerings of diagrams stored in a SQLite file. Each
+    process opens its own connection, the file can be shared.
+    """
+
+    def __init__(self, path: str | pathlib.Path,
+            version: int = ANATOMICAL_SCORE_VERSION) -> None:
+        self.path = pathlib.Path(path)
+        self.version = version
+        self._connection = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be used by forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=TIMEOUT)
+            self._pid = os.getpid()
+            # Readers don't block the writer, and commits don't wait for the disk
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            # No type for score, so that ints (e.g. 1 for open chords) stay ints
+            self._connection.execute('CREATE TABLE IF NOT EXISTS scores ('
+                    'diagram TEXT, version INTEGER, score, fingering TEXT, '
+                    'PRIMARY KEY (diagram, version))')
+        return self._connection
+
+    def get(self, diagram: str) -> Tuple[float, Fingering | None] | None:
+        row = self._connect().execute(
+                'SELECT score, fingering FROM scores WHERE diagram = ? AND version = ?',
+                (diagram, self.version)).fetchone()
+        if row is None:
+            return None
+        return row[0], _load_fingering(row[1])
+
+    def put(self, diagram: str, score: float, fingering: Fingering | None) -> None:
+        self.put_many([(diagram, score, fingering)])
+
+    def put_many(self, rows: Iterable[Tuple[str, float, Fingering | None]]) -> None:
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                    'INSERT OR IGNORE INTO scores VALUES (?, ?, ?, ?)',
+                    [(diagram, self.version, score, _dump_fingering(fingering))
+                        for diagram, score, fingering in rows])
+
+    def diagrams(self) -> set:
+        return {row[0] for row in self._connect().execute(
+            'SELECT diagram FROM scores WHERE version = ?', (self.version,))}
+
+    def __len__(self) -> int:
+        return self._connect().execute(
+                'SELECT COUNT(*) FROM scores WHERE version = ?', (self.version,)).fetchone()[0]
+
+    def close(self) -> None:
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
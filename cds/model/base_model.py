@@ -9,7 +9,6 @@ from torchmetrics import Accuracy, Precision, Recall, F1Score
 from cds.data.dataset import TorchDataset
 from cds.model.losses import pitch_class_loss, completeness_metric, open_chord_metric, playability_metric
 import cds.model.losses as Lo
-import music21 as m21
 
 class FingeringPredictor(L.LightningModule):
     def __init__(self, with_mute: bool = True, 
@@ -88,19 +87,21 @@ class FingeringPredictor(L.LightningModule):
         pred_bin = self.binarize(y_hat)
         fingerings = pred_bin.view((y_hat.size()[0], NUM_STRINGS, self.num_frets))
         expected = y.view((y_hat.size()[0], NUM_STRINGS, self.num_frets))
-        expected_notes = Lo._midi_notes_from_fingering_batchwise(expected[:, :,:-1])
-        expected_notes = [[m21.note.Note(a).name for a in expected_notes[i] if a !=0] for i in range(len(expected_notes))]
-        pred_notes = Lo._midi_notes_from_fingering_batchwise(pred_bin[:, :, :-1])
-        pred_notes = [[m21.note.Note(a).name for a in pred_notes[i] if a !=0] for i in range(len(pred_notes))]
-        pc_prec = torch.Tensor([Lo.pc_precision(expected_notes[i], pred_notes[i]) for i in range(len(expected_notes))])
-        pc_rec = torch.Tensor([Lo.pc_recall(expected_notes[i], pred_notes[i]) for i in range(len(expected_notes))])
+        expected_notes, _ = Lo.midi_notes_from_fingering_batch(expected[:, :,:-1])
+        pred_notes, pred_valid = Lo.midi_notes_from_fingering_batch(pred_bin[:, :, :-1])
+        # Predictions with several notes on one string have no pitch classes,
+        # they are left out of the PC metrics and counted in Test/PC-invalid
+        num_valid = int(pred_valid.sum())
+        expected_pcs = Lo.pitch_class_mask(expected_notes[pred_valid])
+        pred_pcs = Lo.pitch_class_mask(pred_notes[pred_valid])
+        pc_prec = Lo.pc_precision_batch(expected_pcs, pred_pcs).cpu()
+        pc_rec = Lo.pc_recall_batch(expected_pcs, pred_pcs).cpu()
         oc = self.oc_metric(fingerings, expected)
         sw_exact = self.sf_exactness(fingerings, expected)
         sf_prec = self.sf_prec(fingerings, expected, with_mute=self.with_mute)
         sf_rec = self.sf_rec(fingerings, expected, with_mute=self.with_mute)
         sf_f1 = self.sf_f1(fingerings, expected, with_mute=self.with_mute)
-        pc_f1 = torch.div(2*pc_prec*pc_rec, pc_prec+pc_rec)
-        pc_f1 = torch.nan_to_num(pc_f1, nan=0)
+        pc_f1 = Lo.pc_f1_batch(expected_pcs, pred_pcs).cpu()
         diagrams = [TorchDataset.fingering_from_target_tensor(pred_bin.view((batch_size, NUM_STRINGS, self.num_frets))[i], with_mute=self.with_mute) for i in range(batch_size)]
         diagrams_previous = [TorchDataset.fingering_from_source_tensor(x[i], with_mute=self.with_mute) for i in range(batch_size)]
         playability = torch.Tensor([Lo.anatomical_score(diagrams[i])[0] for i in range(len(diagrams))])
@@ -131,15 +132,18 @@ class FingeringPredictor(L.LightningModule):
         self.log("Test/SF rec", sf_rec.mean())
         self.log("Test/SF prec", sf_prec.mean())
         self.log("Test/SF F1", sf_f1.mean())
-        self.log("Test/PC F1", pc_f1.mean())
         self.log("Test/F1", f1)
         self.log("Test/exactness", self.exact_acc(pred_bin, y))
         self.log("Test/StringExactness", sw_exact.mean())
-        self.log("Test/PC-Recall", pc_rec.mean())
         self.log("Test/playability", playability.mean())
         self.log("Test/unplayable", unplayable.mean(dtype=torch.float32))
         self.log("Test/open-closed", oc.mean(dtype=torch.float32))
-        self.log("Test/PC-Precision", pc_prec.mean())
+        if num_valid > 0:
+            # Averaged over the valid predictions of all batches
+            self.log("Test/PC F1", pc_f1.mean(), batch_size=num_valid)
+            self.log("Test/PC-Recall", pc_rec.mean(), batch_size=num_valid)
+            self.log("Test/PC-Precision", pc_prec.mean(), batch_size=num_valid)
+        self.log("Test/PC-invalid", (~pred_valid).mean(dtype=torch.float32))
         self.log('Test/transition_cost', transition_costs.mean())
         self.log('Test/ratio_muted', torch.Tensor(n_r_muted).mean())
         self.log('Test/ratio_open', torch.Tensor(n_r_open).mean())
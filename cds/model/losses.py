@@ -1,15 +1,15 @@
 from math import exp, sqrt
+import functools
 import warnings
 import torch
 from cds.config import NUM_FRETS, NUM_STRINGS, PITCH_CLASSES, TUNING, MIDI_MAP, HANDSPAN
 from typing import List, Tuple, Dict
-from cds.data.dataset import TorchDataset
 from cds.data.open_chords import manyhot_is_open_chord
 from torch.nn import Softmax, Threshold
 import itertools
 from collections import defaultdict
 from cds.data.shape_to_manyhot import shape_to_manyhot
-import music21 as m21
+from cds.model.anatomical_table import AnatomicalTable
 
 TORCH_TUNING = torch.Tensor(TUNING)
 SOFTMAX = Softmax(-1)
@@ -23,6 +23,9 @@ MIN_RANGE = torch.Tensor([[0 , 5  , 15, 25 ],
                           [5 , 0  , 6 , 12 ],
                           [15, 6  , 0 , 8.5],
                           [25, 12 ,8.5, 0  ]])
+# Number of diagrams whose anatomical score is kept in memory
+ANATOMICAL_CACHE_SIZE = 2**16
+_anatomical_table = None
 
 def _midi_notes_from_fingering(fingering: torch.Tensor,
         tuning: torch.Tensor=TORCH_TUNING, midi_map: torch.Tensor = MIDI_MAP) -> torch.Tensor | None:
@@ -35,77 +38,96 @@ def _midi_notes_from_fingering(fingering: torch.Tensor,
     pitches[:len(notes_indices[1])] = midi_map[notes_indices]
     return pitches
 
+def midi_notes_from_fingering_batch(fingering: torch.Tensor,
+        midi_map: torch.Tensor = MIDI_MAP) -> Tuple[torch.Tensor, torch.Tensor]:
+    """midi_notes_from_fingering_batch.
+    Pitch of the note played on each string of a batch of fingerings.
+
+    Args:
+        fingering (torch.Tensor): fingering [BATCHSIZE, NUM_STRINGS, NUM_FRETS], without the mute column
+        midi_map (torch.Tensor): midi_map [NUM_STRINGS, NUM_FRETS]
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: pitches [BATCHSIZE, NUM_STRINGS], 0 on
+        the strings that are not played, and valid [BATCHSIZE], False for the
+        fingerings with several notes on one string (these strings get 0).
+    """
+    pressed = fingering != 0
+    num_notes = pressed.sum(dim=-1)
+    frets = pressed.to(torch.uint8).argmax(dim=-1)
+    midi_map = midi_map.to(fingering.device).expand(fingering.size()[0], -1, -1)
+    pitches = torch.gather(midi_map, -1, frets[..., None])[..., 0]
+    pitches = torch.where(num_notes == 1, pitches, 0)
+    valid = (num_notes <= 1).all(dim=-1)
+    return pitches, valid
+
 def _midi_notes_from_fingering_batchwise(fingering):
     """
-    Je n'ai pas trouvé comment faire sans boucle for pour le moment.
+    Pitches of the fingerings that have at most one note per string, see
+    midi_notes_from_fingering_batch to keep the other rows aligned.
     """
-    out = []
-    for i in range(fingering.size()[0]):
-        try:
-            out.append(_midi_notes_from_fingering(fingering[i]))
-        except ValueError:
-            warnings.warn("Too many notes.")
-            continue
-    return torch.stack(out) if len(out) > 0 else None
+    pitches, valid = midi_notes_from_fingering_batch(fingering)
+    if not valid.all():
+        warnings.warn("Too many notes.")
+    return pitches[valid] if valid.any() else None
+
+def pitch_class_mask(notes: torch.Tensor, num_pc: int = PITCH_CLASSES) -> torch.Tensor:
+    """
+    Pitch classes played by notes [(BATCHSIZE,) NUM_STRINGS] as a bool mask
+    [(BATCHSIZE,) num_pc], 0 being a string that is not played.
+    """
+    pcs = torch.nn.functional.one_hot(notes.long() % num_pc, num_pc)
+    return (pcs * (notes != 0)[..., None]).any(dim=-2)
 
 def _are_notes_accepted(accepted_pitches: torch.Tensor, root_note: torch.Tensor,
         notes: torch.Tensor, num_pc: int = PITCH_CLASSES) -> torch.Tensor:
-    if accepted_pitches.ndim == 2:
-        return _are_notes_accepted_batchwise(accepted_pitches, root_note, notes)
-    notes = notes[notes.nonzero()] % num_pc
-    accepted_pitches = torch.nonzero(accepted_pitches, as_tuple=False)
-    out = torch.ones((NUM_STRINGS), dtype=torch.bool)
-    out[:notes.size()[0]] = torch.isin(notes, accepted_pitches)[:, 0]
-    return out
-
-
-def _are_notes_accepted_batchwise(accepted_pitches, root_note, notes):
-    out = []
-    for i in range(notes.size()[0]):
-        out.append(_are_notes_accepted(accepted_pitches[i],
-            root_note[i], notes[i]))
-    return torch.stack(out)
+    """
+    Whether the pitch class of each note [BATCHSIZE, NUM_STRINGS] is in
+    accepted_pitches [BATCHSIZE, num_pc], strings not played being accepted.
+    """
+    accepted = torch.gather(accepted_pitches != 0, -1, notes.long() % num_pc)
+    return accepted | (notes == 0)
 
 def _is_chord_complete(required_pitches: torch.Tensor, root_note: torch.Tensor,
         notes: torch.Tensor, num_pc: int = PITCH_CLASSES) -> torch.Tensor:
-    if required_pitches.ndim == 2:
-        return _is_chord_complete_batchwise(required_pitches, root_note, notes)
-    notes = notes[notes.nonzero()] % num_pc
-    required_pitches = torch.nonzero(required_pitches, as_tuple=False)
-    out = torch.isin(required_pitches, notes)[:, 0]
-    return out.mean(dtype=torch.float32)
-
-def _is_chord_complete_batchwise(required_pitches, root_note, notes):
-    out = []
-    for i in range(notes.size()[0]):
-        out.append(_is_chord_complete(required_pitches[i],
-            root_note[i], notes[i]))
-    return torch.stack(out)
+    """
+    Ratio of the pitch classes of required_pitches [BATCHSIZE, num_pc] played
+    by notes [BATCHSIZE, NUM_STRINGS].
+    """
+    required = required_pitches != 0
+    played = pitch_class_mask(notes, num_pc)
+    return (required & played).sum(dim=-1) / required.sum(dim=-1)
 
-def _is_playable(fingering_vector: torch.Tensor, handspan: int, with_mute: bool=False) -> torch.Tensor:
-    if fingering_vector.ndim == 3:
-        return _is_playable_batchwise(fingering_vector, handspan, with_mute)
-    else:
-        fingering_str = TorchDataset.fingering_from_target_tensor(fingering_vector, with_mute=with_mute)
-        min_fret = 25
-        max_fret = 0
-        for char in fingering_str.split('.'):
-            if char in ['x', '']:
-                continue
-            else:
-                fret = int(char)
-                if fret > max_fret:
-                    max_fret = fret
-                if fret < min_fret and fret != 0:
-                    min_fret = fret
-        return torch.Tensor([max_fret - min_fret <= handspan])
+def fret_span_batch(fingering_vector: torch.Tensor, with_mute: bool = False) -> torch.Tensor:
+    """fret_span_batch.
+    Same as _get_fret_span on the diagrams of a batch of fingerings, without
+    going through strings: frets are the values equal to 1, strings whose
+    largest value is the mute column are muted.
 
-def _is_playable_batchwise(fingering_vector: torch.Tensor, handspan: int, with_mute: bool) -> torch.Tensor:
-    to_stack = []
-    for vec in fingering_vector:
-        to_stack.append(_is_playable(vec, handspan, with_mute))
-    return torch.stack(to_stack, dim=0)
+    Args:
+        fingering_vector (torch.Tensor): fingering_vector [BATCHSIZE, NUM_STRINGS, num_frets]
+        with_mute (bool): whether the last column is the mute column
+
+    Returns:
+        torch.Tensor: [BATCHSIZE], difference between the highest fret and the
+        lowest fret other than 0, 0 without such frets.
+    """
+    num_frets = NUM_FRETS + 1 if with_mute else NUM_FRETS
+    fingering_vector = fingering_vector.reshape(-1, NUM_STRINGS, num_frets)
+    pressed = fingering_vector[:, :, :NUM_FRETS] == 1
+    if with_mute:
+        muted = fingering_vector.argmax(dim=-1) == num_frets - 1
+        pressed = pressed & ~muted[:, :, None]
+    frets = torch.arange(NUM_FRETS, device=fingering_vector.device)
+    max_fret = torch.where(pressed, frets, 0).amax(dim=(1, 2))
+    min_fret = torch.where(pressed & (frets > 0), frets, 25).amin(dim=(1, 2))
+    return (max_fret - min_fret).clamp(min=0)
 
+def _is_playable(fingering_vector: torch.Tensor, handspan: int, with_mute: bool=False) -> torch.Tensor:
+    out = (fret_span_batch(fingering_vector, with_mute) <= handspan).type(torch.float32)
+    if fingering_vector.ndim == 3:
+        return out[:, None]
+    return out
 
 def pitch_class_loss(chord_vector: torch.Tensor,
         fingering_vector: torch.Tensor,
@@ -126,7 +148,8 @@ def pitch_class_loss(chord_vector: torch.Tensor,
         num_pc (int): num_pc
 
     Returns:
-        torch.Tensor:
+        torch.Tensor: [BATCHSIZE], ratio of the strings whose note is in the chord
+        (strings not played included), 0 for fingerings with several notes on one string.
     """
     if chord_vector.ndim == 1:
         chord_vector = chord_vector[None, :]
@@ -136,13 +159,10 @@ def pitch_class_loss(chord_vector: torch.Tensor,
         fingering_vector = fingering_vector[:, :, :-1]
     root_note_vector = chord_vector[:, :num_pc]
     accepted_pitches = chord_vector[:, num_pc:]
-    notes = _midi_notes_from_fingering(fingering_vector)
-    print(notes)
-    if notes is None:
-        return None
+    notes, valid = midi_notes_from_fingering_batch(fingering_vector)
     res = _are_notes_accepted(accepted_pitches, root_note_vector, notes)
-    print(res)
-    return res.mean(dim=-1, dtype=torch.float32)
+    # Several notes on one string can't be consistent with the chord
+    return torch.where(valid, res.mean(dim=-1, dtype=torch.float32), 0)
 
 def completeness_metric(chord_vector: torch.Tensor,
         fingering_vector: torch.Tensor,
@@ -160,10 +180,10 @@ def completeness_metric(chord_vector: torch.Tensor,
         fingering_vector = fingering_vector[:, :, :-1]
     root_note_vector = chord_vector[:, :num_pc]
     accepted_pitches = chord_vector[:, num_pc:]
-    notes = _midi_notes_from_fingering(fingering_vector)
-    if notes is None:
-        return 0
+    notes, valid = midi_notes_from_fingering_batch(fingering_vector)
     res = _is_chord_complete(accepted_pitches, root_note_vector, notes)
+    # Fingerings with several notes on one string are not complete
+    res = torch.where(valid, res, 0)
     return res.mean(dim=-1, dtype=torch.float32)
 
 def open_chord_metric(fingering_vector: torch.Tensor, expected_fingering:torch.Tensor) -> torch.Tensor:
@@ -351,6 +371,40 @@ def pc_recall(expected_notes: List[str], pred_notes: List[str]) -> float:
     missing_notes = expected.difference(pred)
     return (size - len(missing_notes))/size
 
+def pc_precision_batch(expected_pcs: torch.Tensor, pred_pcs: torch.Tensor) -> torch.Tensor:
+    """pc_precision_batch.
+    pc_precision of pitch class masks (see pitch_class_mask).
+
+    Args:
+        expected_pcs (torch.Tensor): expected_pcs [BATCHSIZE, PITCH_CLASSES]
+        pred_pcs (torch.Tensor): pred_pcs [BATCHSIZE, PITCH_CLASSES]
+
+    Returns:
+        torch.Tensor: [BATCHSIZE], 1 when nothing is predicted.
+    """
+    size = pred_pcs.sum(dim=-1)
+    correct = (expected_pcs & pred_pcs).sum(dim=-1)
+    return torch.where(size == 0, 1, correct / size.clamp(min=1))
+
+def pc_recall_batch(expected_pcs: torch.Tensor, pred_pcs: torch.Tensor) -> torch.Tensor:
+    """pc_recall_batch.
+    pc_recall of pitch class masks (see pitch_class_mask).
+
+    Args:
+        expected_pcs (torch.Tensor): expected_pcs [BATCHSIZE, PITCH_CLASSES]
+        pred_pcs (torch.Tensor): pred_pcs [BATCHSIZE, PITCH_CLASSES]
+
+    Returns:
+        torch.Tensor: [BATCHSIZE], 1 when nothing is expected.
+    """
+    return pc_precision_batch(pred_pcs, expected_pcs)
+
+def pc_f1_batch(expected_pcs: torch.Tensor, pred_pcs: torch.Tensor) -> torch.Tensor:
+    prec = pc_precision_batch(expected_pcs, pred_pcs)
+    rec = pc_recall_batch(expected_pcs, pred_pcs)
+    out = torch.div(2*prec*rec, prec+rec)
+    return torch.nan_to_num(out, nan=0)
+
 
 def fret_distance(m: int, n: int, scale_length: float = 620) -> float:
     if m > n:
@@ -445,7 +499,7 @@ def _anatomical_score(fingering: Dict[int, List[Tuple[int, int]]]) -> float:
     return score/div
 
 
-def anatomical_score(diagram: str) -> Tuple[float, Dict[int, Tuple[int, int]]]:
+def compute_anatomical_score(diagram: str) -> Tuple[float, Dict[int, Tuple[int, int]]]:
     string_fret_set = get_string_fret_set(diagram)
     only_open_strings = True
     for sf in string_fret_set:
@@ -464,6 +518,33 @@ def anatomical_score(diagram: str) -> Tuple[float, Dict[int, Tuple[int, int]]]:
             best_fingering = fingering
     return score, best_fingering
 
+def set_anatomical_table(path: str | None) -> None:
+    """
+    Read and store the anatomical scores in the table at path (see
+    anatomical_table.py), None to only keep them in memory.
+    """
+    global _anatomical_table
+    if _anatomical_table is not None:
+        _anatomical_table.close()
+    _anatomical_table = AnatomicalTable(path) if path is not None else None
+    anatomical_score.cache_clear()
+
+@functools.lru_cache(maxsize=ANATOMICAL_CACHE_SIZE)
+def anatomical_score(diagram: str) -> Tuple[float, Dict[int, Tuple[int, int]]]:
+    """
+    compute_anatomical_score, memoized in memory and in the anatomical table
+    if one is set. The same fingering is returned for the same diagram, it
+    must not be modified.
+    """
+    if _anatomical_table is not None:
+        scored = _anatomical_table.get(diagram)
+        if scored is not None:
+            return scored
+    score, best_fingering = compute_anatomical_score(diagram)
+    if _anatomical_table is not None:
+        _anatomical_table.put(diagram, score, best_fingering)
+    return score, best_fingering
+
 
 def wrist_movement(fingering1: Dict[int, List[Tuple[int, int]]],
         fingering2: Dict[int, List[Tuple[int, int]]]) -> int:
@@ -532,8 +613,8 @@ def ratio_unique_notes(diagram: str, num_strings: int = NUM_STRINGS) -> float:
         diagram = diagram[:-1]
     array = shape_to_manyhot(diagram, with_mute=False)
     notes = _midi_notes_from_fingering(array)
-    notes_reduced = set([m21.note.Note(a).name for a in notes if a != 0])
+    num_pcs = pitch_class_mask(notes).sum().item()
     num_notes_played = num_strings_played(diagram, num_strings)
     if num_notes_played == 0:
         return 0
-    return len(notes_reduced)/num_notes_played
+    return num_pcs/num_notes_played
@@ -20,6 +20,8 @@ from statistics import mean, stdev
 
 def main(parser: ArgumentParser) -> int:
     args = parser.parse_args()
+    if args.anatomical_table:
+        Lo.set_anatomical_table(args.anatomical_table)
     SOURCEPATH = pathlib.Path(args.sourcepath)
     if SOURCEPATH.is_dir():
         ckpts = sorted(list(SOURCEPATH.glob("*.ckpt")))
@@ -49,15 +51,20 @@ def main(parser: ArgumentParser) -> int:
             if args.verbose:
                 print(f"Testing the model on {DATAPATH}")
             if args.strict:
-                data = TorchDataset(dataset, None, model.with_mute, drop_duplicates_strict=True) 
+                data = TorchDataset(dataset, None, model.with_mute, drop_duplicates_strict=True,
+                        cache_dir=args.cache_dir)
             elif args.stricter:
-                data = TorchDataset(dataset, None, model.with_mute, drop_duplicates_stricter=True) 
+                data = TorchDataset(dataset, None, model.with_mute, drop_duplicates_stricter=True,
+                        cache_dir=args.cache_dir)
             elif args.strictest:
-                data = TorchDataset(dataset, None, model.with_mute, drop_duplicates_strictest=True) 
+                data = TorchDataset(dataset, None, model.with_mute, drop_duplicates_strictest=True,
+                        cache_dir=args.cache_dir)
             else:
-                data = TorchDataset(dataset, None, model.with_mute) 
+                data = TorchDataset(dataset, None, model.with_mute,
+                        cache_dir=args.cache_dir)
             print("Final dataset size is: ", data.__len__())
-            dataloader = DataLoader(data, batch_size=args.batch_size)
+            dataloader = DataLoader(data, batch_size=args.batch_size,
+                    collate_fn=TorchDataset.collate)
             trainer = L.Trainer()
             trainer.test(model, dataloader)
             for k,v in trainer.logged_metrics.items():
@@ -149,6 +156,10 @@ if __name__ == '__main__':
             help="Drop duplicates from test set on nextchord and nextposition.")
     parser.add_argument('--strictest', action='store_true',
             help="Drop duplicates from test set on nextposition.")
+    parser.add_argument('--cache-dir', type=str,
+            help="Folder where the encoded datasets are saved, and loaded from in later runs.")
+    parser.add_argument('--anatomical-table', type=str,
+            help="Table of precomputed anatomical scores (see cds/data/anatomical_scores-script.py), filled with new diagrams.")
     parser.add_argument('-B', '--batch-size', type=int,
             default=32,
             help="Batch Size for test dataloader.")
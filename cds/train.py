@@ -1,6 +1,6 @@
 import lightning as L
 from cds.config import NUM_FRETS, NUM_STRINGS, PITCH_CLASSES
-from cds.data.dataset import TorchDataset
+from cds.data.dataset import TorchDataset, ShardedDataset
 from cds.model.base_model import FingeringPredictor, FingeringPredictorBaseline
 from cds.model.multilayer_model import MultiLayerFingeringPredictor, MultilayerBaseline
 from argparse import ArgumentParser
@@ -21,11 +21,21 @@ def main(parser: ArgumentParser) -> int:
     args = parser.parse_args()
     seed_everything(args.seed, workers=True)
     # Datasets and Dataloaders
-    dataset = TorchDataset(df_path=args.dataframe, df = None,
-            augment=args.augment)
-    valset = TorchDataset(df_path=args.validation_set, df=None)
-    dataloader = DataLoader(dataset, batch_size=BATCHSIZE, num_workers=WORKERS, shuffle=True)
-    valloader = DataLoader(valset, batch_size=BATCHSIZE, num_workers=WORKERS)
+    if args.shards:
+        dataset = ShardedDataset(args.shards, lazy_augment=args.lazy_augment)
+    else:
+        dataset = TorchDataset(df_path=args.dataframe, df = None,
+                augment=args.augment, pretensorize=args.pretensorize,
+                cache_dir=args.cache_dir, lazy_augment=args.lazy_augment,
+                packed=args.packed)
+    valset = TorchDataset(df_path=args.validation_set, df=None,
+            pretensorize=args.pretensorize, cache_dir=args.cache_dir,
+            packed=args.packed)
+    # Sharded datasets are shuffled by their workers
+    dataloader = DataLoader(dataset, batch_size=BATCHSIZE, num_workers=WORKERS,
+            shuffle=not args.shards, collate_fn=TorchDataset.collate)
+    valloader = DataLoader(valset, batch_size=BATCHSIZE, num_workers=WORKERS,
+            collate_fn=TorchDataset.collate)
     # Lightning Trainer
     name = "{version}-{epoch}-{val_loss:.3f}-"
     name += args.ckpt_name
@@ -59,12 +69,22 @@ if __name__ == '__main__':
     parser = ArgumentParser(description="Script to train a Lightning model.")
     parser.add_argument('-df', '--dataframe', type=str,
             default="data/mySongBook/train/mySongBook-chordpairs-train-split_1111.csv")
+    parser.add_argument('--shards', type=str,
+            help="Folder of Parquet shards (see cds/data/shards.py) streamed instead of --dataframe.")
     parser.add_argument("-vdf", "--validation-set", type=str,
             default="data/mySongBook/val/mySongBook-chordpairs-val-split_1111.csv")
     parser.add_argument('--learning-rate', type=float, default=0.001,
             help="Learning rate for implemented models.")
     parser.add_argument('--augment', action='store_true',
             help="Train with data augmentation.")
+    parser.add_argument('--lazy-augment', action='store_true',
+            help="Train with data augmentation, transposing each sample by a random number of semitones when it is read, within the same bounds as --augment (down to a fret containing a 0, up to the twelfth fret).")
+    parser.add_argument('--pretensorize', action='store_true',
+            help="Encode the datasets once before training instead of for every sample.")
+    parser.add_argument('--packed', action='store_true',
+            help="Keep the encoded diagrams as packed integers, expanded when read.")
+    parser.add_argument('--cache-dir', type=str,
+            help="Folder where the encoded datasets are saved, and loaded from in later runs.")
     parser.add_argument('-l', '--label-only', action="store_true",
             help="Train the baseline model that only uses label information.")
     parser.add_argument('-n', '--name', type=str, required=True,